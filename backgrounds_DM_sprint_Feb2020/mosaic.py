@@ -0,0 +1,151 @@
+"""Render mosaics of patch images (coadds or background models) to PNG.
+
+The stretch range is computed once for the whole mosaic from pixels sampled
+from every patch, so that all tiles share the same display scale; the
+patches are then stretched and written as tiles in a process pool, and the
+tiles are assembled into the final PNG. This is how comparison plots such as
+``bg64_bg_patches23_24_33_34.png`` can be made for whole tracts.
+
+Example, for a 2x2 block of patches of a background model::
+
+    python mosaic.py bg_2,3.fits bg_3,3.fits bg_2,4.fits bg_3,4.fits \
+        --ncols 2 --stretch asinh -o plots/bg64_bg_patches23_24_33_34.png
+"""
+import argparse
+import contextlib
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from astropy.io import fits
+from PIL import Image
+
+import img_scale
+
+
+def read_patch(filename, hdu=1, border=0):
+    """Read the image of a patch as float32, trimming `border` pixels from
+    each side (e.g. the overlap between coadd patches)."""
+    with fits.open(filename, memmap=True) as hdul:
+        data = hdul[hdu].data
+        if border:
+            data = data[border:-border, border:-border]
+        return np.array(data, dtype=np.float32)
+
+
+def _sample_patch(filename, hdu, border, n_samples):
+    data = read_patch(filename, hdu=hdu, border=border)
+    sample = img_scale.zscale_sample(data, n_samples)
+    return sample[np.isfinite(sample)]
+
+
+def _render_tile(filename, tile_name, hdu, border, stretch, lut):
+    data = read_patch(filename, hdu=hdu, border=border)
+    bad = ~np.isfinite(data)
+    data[bad] = stretch.scale_min if stretch is not None else lut[1]
+    if stretch is not None:
+        stretch(data, out=data)
+    else:
+        data = img_scale.histeq(data, lut=lut)
+    np.clip(data, 0, 1, out=data)
+    data[bad] = 0
+    # images have their origin at the lower left, PNGs at the upper left
+    tile = np.flipud((255 * data).astype(np.uint8))
+    Image.fromarray(tile).save(tile_name)
+    return tile.shape
+
+
+def stretch_for_mosaic(samples, stretch='asinh', range_method='zscale', contrast=0.25,
+                       percentile_cut=0.01, num_bins=1024, **kwargs):
+    """Set up the stretch for a mosaic from its pooled pixel samples.
+
+    Returns an `img_scale.Stretch` of the requested kind whose range comes from
+    `img_scale.range_from_zscale` or `img_scale.range_from_percentile`, or, for
+    ``stretch='histeq'``, a lookup table from `img_scale.histeq_lut`. Extra
+    keyword arguments go to `img_scale.Stretch`."""
+    if stretch == 'histeq':
+        return img_scale.histeq_lut(samples, num_bins=num_bins)
+    if range_method == 'zscale':
+        scale_min, scale_max, _ = img_scale.range_from_zscale(samples, contrast=contrast)
+    elif range_method == 'percentile':
+        scale_min, scale_max = img_scale.range_from_percentile(
+            samples, low_cut=percentile_cut, high_cut=percentile_cut)
+    else:
+        raise ValueError(f"range_method must be 'zscale' or 'percentile', not {range_method!r}")
+    return img_scale.Stretch(stretch, scale_min=scale_min, scale_max=scale_max, **kwargs)
+
+
+def render_mosaic(filenames, output, ncols, stretch='asinh', hdu=1, border=0,
+                  n_samples=100000, processes=None, tile_dir=None, **kwargs):
+    """Render patch images to a single PNG mosaic.
+
+    `filenames` are laid out in rows of `ncols` patches, starting from the
+    lower left as in a tract (i.e. in the order of increasing patch y, then
+    x). About `n_samples` pixels in total are sampled across all patches to
+    set one stretch for the whole mosaic (see `stretch_for_mosaic`, which also
+    takes the extra keyword arguments); each patch is then stretched and
+    written as a tile in `tile_dir` (a temporary directory by default) by a
+    pool of `processes` workers, and the tiles are assembled into `output`.
+    Returns the stretch (or histogram equalisation lookup table) used."""
+    n_tiles = len(filenames)
+    per_patch = max(1, n_samples // max(n_tiles, 1))
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        samples = list(pool.map(_sample_patch, filenames, [hdu]*n_tiles, [border]*n_tiles,
+                                [per_patch]*n_tiles))
+        scaling = stretch_for_mosaic(np.concatenate(samples), stretch=stretch, **kwargs)
+        is_lut = stretch == 'histeq'
+        if tile_dir is not None:
+            os.makedirs(tile_dir, exist_ok=True)
+        with (contextlib.nullcontext(tile_dir) if tile_dir is not None
+              else tempfile.TemporaryDirectory()) as tmp_dir:
+            tile_names = [os.path.join(tmp_dir, f'tile_{idx:04d}.png') for idx in range(n_tiles)]
+            shapes = list(pool.map(_render_tile, filenames, tile_names, [hdu]*n_tiles,
+                                   [border]*n_tiles, [None if is_lut else scaling]*n_tiles,
+                                   [scaling if is_lut else None]*n_tiles))
+            assemble_tiles(tile_names, shapes, ncols, output)
+    return scaling
+
+
+def assemble_tiles(tile_names, shapes, ncols, output):
+    """Paste PNG tiles of the given (height, width) `shapes` into one PNG,
+    with the first row of `ncols` tiles at the bottom."""
+    nrows = (len(tile_names) + ncols - 1) // ncols
+    widths = np.zeros(ncols, dtype=int)
+    heights = np.zeros(nrows, dtype=int)
+    for idx, (height, width) in enumerate(shapes):
+        row, col = divmod(idx, ncols)
+        widths[col] = max(widths[col], width)
+        heights[row] = max(heights[row], height)
+    x0 = np.concatenate(([0], np.cumsum(widths)))
+    # rows go upwards from the bottom of the mosaic
+    y0 = np.sum(heights) - np.cumsum(heights)
+    mosaic = Image.new('L', (int(x0[-1]), int(np.sum(heights))))
+    for idx, tile_name in enumerate(tile_names):
+        row, col = divmod(idx, ncols)
+        with Image.open(tile_name) as tile:
+            mosaic.paste(tile, (int(x0[col]), int(y0[row] + heights[row] - shapes[idx][0])))
+    mosaic.save(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('filenames', nargs='+', help='patch image FITS files, row by row '
+                        'from the lower left')
+    parser.add_argument('-o', '--output', required=True, help='output PNG')
+    parser.add_argument('--ncols', type=int, required=True, help='number of patches per row')
+    parser.add_argument('--stretch', default='asinh', choices=img_scale.Stretch.kinds + ('histeq',))
+    parser.add_argument('--range', dest='range_method', default='zscale',
+                        choices=('zscale', 'percentile'))
+    parser.add_argument('--hdu', type=int, default=1, help='HDU holding the image')
+    parser.add_argument('--border', type=int, default=0, help='pixels to trim from each side')
+    parser.add_argument('--samples', type=int, default=100000, help='total pixels sampled')
+    parser.add_argument('-j', '--processes', type=int, default=None)
+    args = parser.parse_args()
+    render_mosaic(args.filenames, args.output, args.ncols, stretch=args.stretch, hdu=args.hdu,
+                  border=args.border, n_samples=args.samples, processes=args.processes,
+                  range_method=args.range_method)
+
+
+if __name__ == '__main__':
+    main()
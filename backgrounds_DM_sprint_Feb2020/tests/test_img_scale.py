@@ -0,0 +1,102 @@
+import math
+import os
+import sys
+
+import numpy
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import img_scale  # noqa: E402
+
+
+@pytest.fixture
+def sky():
+	rng = numpy.random.default_rng(1)
+	data = rng.normal(100., 5., (200, 200)).astype(numpy.float32)
+	data[50:60, 50:60] = 5000.
+	return data
+
+
+def test_masked_array_mask_is_used(sky):
+	masked = numpy.ma.masked_array(sky, mask=numpy.zeros(sky.shape, dtype=bool))
+	masked.mask[:100] = True
+	masked.data[:100] = 1e6
+	result = img_scale.sky_sig_clip(masked, 3., 0.001)
+	expected = img_scale.sky_sig_clip(sky[100:], 3., 0.001)
+	assert result == expected
+	assert result[2] < sky[100:].size
+
+
+def test_masked_array_and_mask_are_combined(sky):
+	masked = numpy.ma.masked_array(sky, mask=numpy.zeros(sky.shape, dtype=bool))
+	masked.mask[:100] = True
+	mask = numpy.zeros(sky.shape, dtype=numpy.int32)
+	mask[:, :100] = 4
+	result = img_scale.sky_sig_clip(masked, 3., 0.001, mask=mask, mask_bits=4)
+	assert result == img_scale.sky_sig_clip(sky[100:, 100:], 3., 0.001)
+
+
+@pytest.mark.parametrize('stat', ['median', 'mean'])
+def test_no_usable_pixels(sky, stat):
+	all_masked = numpy.ma.masked_array(sky, mask=True)
+	all_nan = numpy.full(sky.shape, numpy.nan, dtype=numpy.float32)
+	for data in (all_masked, all_nan):
+		sky_value, iteration, n_pix, sig = img_scale.sky_sig_clip(data, 3., 0.001, stat=stat)
+		assert math.isnan(sky_value) and math.isnan(sig)
+		assert (iteration, n_pix) == (0, 0)
+	assert math.isnan(img_scale.sky_median_sig_clip(all_nan, 3., 0.001)[0])
+
+
+def test_overwrite_input_with_mask(sky):
+	mask = numpy.zeros(sky.shape, dtype=numpy.int32)
+	mask[:, :100] = 4
+	mask[:100] |= 1
+	work = sky.copy()
+	work[0, 150] = numpy.nan
+	work[0, 0] = 1e6
+	expected = img_scale.sky_sig_clip(work[:, 100:], 3., 0.001)
+	assert img_scale.sky_sig_clip(work, 3., 0.001, mask=mask, mask_bits=4, overwrite_input=True) == expected
+	with pytest.raises(ValueError):
+		img_scale.sky_sig_clip(sky, 3., 0.001, mask=mask[:10])
+
+
+def test_nan_pixels_are_ignored(sky):
+	with_nan = sky.copy()
+	with_nan[:100] = numpy.nan
+	assert img_scale.sky_sig_clip(with_nan, 3., 0.001) == img_scale.sky_sig_clip(sky[100:], 3., 0.001)
+
+
+@pytest.mark.parametrize('stat', ['median', 'mean'])
+def test_float32_precision_is_kept(sky, stat):
+	sky_value, _, _, sig = img_scale.sky_sig_clip(sky, 3., 0.001, stat=stat)
+	assert isinstance(sky_value, numpy.float32)
+	assert isinstance(sig, numpy.float32)
+	assert abs(sky_value - 100.) < 0.5
+
+
+def test_histeq_ignores_nan_pixels(sky):
+	with_nan = sky.copy()
+	with_nan[:100] = numpy.nan
+	lut = img_scale.histeq_lut(with_nan)
+	expected = img_scale.histeq_lut(sky[100:])
+	assert lut[1:] == expected[1:]
+	numpy.testing.assert_array_equal(lut[0], expected[0])
+	result = img_scale.histeq(with_nan, lut=lut)
+	assert numpy.isnan(result[:100]).all()
+	numpy.testing.assert_array_equal(result[100:], img_scale.histeq(sky[100:]))
+	assert numpy.isnan(img_scale.histeq(numpy.full((4, 4), numpy.nan))).all()
+
+
+@pytest.mark.parametrize('kind', ['linear', 'sqrt', 'power', 'asinh'])
+def test_stretch_range(sky, kind):
+	result = img_scale.Stretch(kind, scale_min=90., scale_max=110.)(sky)
+	assert result.dtype == numpy.float32
+	assert result.min() == 0. and result.max() == 1.
+
+
+def test_stretch_log_keeps_baseline_normalisation():
+	data = numpy.array([5., 50., 100., 200.])
+	result = img_scale.log(data, scale_min=10., scale_max=100.)
+	numpy.testing.assert_allclose(result, [0., math.log10(50.) / math.log10(90.), 2. / math.log10(90.), 1.])
+	assert result[2] > 1.
@@ -1,55 +1,86 @@
 """ This script contains a few helper functions that are common to the
 three notebooks for exploring detections around bright stars."""
+import hashlib
+import os
 import numpy as np
+from scipy.spatial import cKDTree
 from lsst import geom
 import time
 
-def extractBrightStarInfo(tractInfo, mask_path, radMaxPix=0, radInPix=True, verbose=False):
+# where parsed region files are cached, see readBrightStarRegions
+REGION_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "brightStarRegions")
+REGION_DTYPE = [('ra', float), ('dec', float), ('radius', float), ('mag', float)]
+
+def _parseRegionFile(mask_path, verbose=False):
+    """ Parse the circles of a ds9 region file into a structured array with
+    ra, dec, radius (all in degrees) and mag columns."""
+    rows = []
+    with open(mask_path, 'r') as f:
+        for line in f:
+            if line[:6] == 'circle':
+                maskinfo, comm = line.split('#')
+                objid, mag = comm.split(',')
+                maskinfo = maskinfo.split(',')
+                radius = maskinfo[2].split('d')[0] # keep everything before the d
+                rows += [(float(maskinfo[0][7:]), # remove "circle("
+                          float(maskinfo[1]),
+                          float(radius),
+                          float(mag[5:-2]))] # remove " mag:" and the trailing \n
+            elif line[:3] == 'box': # ignore saturation spikes/bleed trails boxes
+                pass
+            else:
+                if verbose:
+                    # check we didn't miss anything important
+                    print(line)
+    return np.array(rows, dtype=REGION_DTYPE)
+
+def readBrightStarRegions(mask_path, cacheDir=REGION_CACHE_DIR, verbose=False):
+    """ Read the bright star masks of a ds9 region file as a structured array
+    with ra, dec, radius (all in degrees) and mag columns.
+    The parsed table is cached in `cacheDir` (set to None to disable), keyed on
+    the region file path and modification time, so that it is only parsed
+    again when the file changes."""
+    if cacheDir is None:
+        return _parseRegionFile(mask_path, verbose=verbose)
+    mask_path = os.path.abspath(mask_path)
+    key = '{}:{}'.format(mask_path, os.path.getmtime(mask_path))
+    cachePath = os.path.join(cacheDir, '{}-{}.npy'.format(
+        os.path.splitext(os.path.basename(mask_path))[0],
+        hashlib.sha1(key.encode()).hexdigest()))
+    if os.path.exists(cachePath):
+        return np.load(cachePath)
+    regions = _parseRegionFile(mask_path, verbose=verbose)
+    os.makedirs(cacheDir, exist_ok=True)
+    # write to a temporary file first so concurrent runs never see a partial cache
+    tmpPath = '{}.{}.tmp.npy'.format(cachePath, os.getpid())
+    np.save(tmpPath, regions)
+    os.replace(tmpPath, cachePath)
+    return regions
+
+def extractBrightStarInfo(tractInfo, mask_path, radMaxPix=0, radInPix=True, verbose=False,
+                          cacheDir=REGION_CACHE_DIR):
     """ Extract mask information from the ds9 region files. This is pretty hacky, but is
     only used for these specific masks - ultimately, it would be better to select the bright
-    objects we look at from an external catalog (Gaia)."""
-    f = open(mask_path, 'r')
+    objects we look at from an external catalog (Gaia).
+    The region file is read through `readBrightStarRegions`, so it is only parsed once
+    per `cacheDir`, and all mask centers are transformed to pixels in a single call.
+    Centers are returned as an (N, 2) array of pixel coordinates."""
+    regions = readBrightStarRegions(mask_path, cacheDir=cacheDir, verbose=verbose)
 
     # boundaries; shrink BBox so largest annuli can fit in entirely
     bBox = tractInfo.getBBox()
     bBox.grow(-int(radMaxPix)-1)
     wcs = tractInfo.getWcs()
 
-    pix_centers = []
-    mags = []
-    radii = []
-
-    for line in f:
-        if line[:6] == 'circle':
-            maskinfo, comm = line.split('#')
-            objid, mag = comm.split(',')
-            maskinfo = maskinfo.split(',')
-            radius = maskinfo[2].split('d')[0] # keep everything before the d
-            circle = [float(maskinfo[0][7:]), # remove "circle("
-                        float(maskinfo[1])]
-            sp = geom.SpherePoint(circle[0], circle[1], geom.degrees)
-            cpix = wcs.skyToPixel(sp)
-            if (cpix[0] >= bBox.beginX and
-                cpix[0] < bBox.endX):
-                if (cpix[1] >= bBox.beginY and
-                    cpix[1] < bBox.endY):
-                    # also save magnitude (as put down by Andy)...
-                    mag = float(mag[5:-2]) # remove " mag:" and the trailing \n
-                    mags += [mag]
-                    # ... and mask radius
-                    radii += [float(radius)]
-                    # if the center of the mask is inside, keep it
-                    pix_centers += [cpix]
-        elif line[:3] == 'box': # ignore saturation spikes/bleed trails boxes
-            pass
-        else:
-            if verbose:
-                # check we didn't miss anything important
-                print(line)
-    f.close()
-    mags = np.array(mags)
-    # convert radii (in degrees) to arcsecpixels
-    radii = np.array(radii) * 3600
+    xPix, yPix = wcs.skyToPixelArray(regions['ra'], regions['dec'], degrees=True)
+    # if the center of the mask is inside, keep it
+    inside = ((xPix >= bBox.beginX) & (xPix < bBox.endX) &
+              (yPix >= bBox.beginY) & (yPix < bBox.endY))
+    pix_centers = np.column_stack((xPix[inside], yPix[inside]))
+    # also save magnitude (as put down by Andy)...
+    mags = regions['mag'][inside]
+    # ... and mask radius, converted from degrees to arcsec
+    radii = regions['radius'][inside] * 3600
     # and, if requested, to pixels
     if radInPix:
         radii /= geom.radToArcsec(wcs.getPixelScale())
@@ -75,8 +106,117 @@ def countInAnnulus(src, brightCen, radiiPix, x_name="base_SdssCentroid_x",
         areas += [np.pi *(radOut**2 - radIn**2)]
     return counts, areas
 
-def countsBeyondMask(src, nbAnnuli, annSizePix, brightCenters, brightRadii, verbose=False):
-    """Compute detected source counts around bright star masks."""
+def centroidArray(src, x_name="base_SdssCentroid_x", y_name="base_SdssCentroid_y"):
+    """ Return the centroids of all detections in `src` as an (N, 2) float array,
+    reading the centroid columns directly rather than calling `getCentroid` on
+    every record."""
+    return np.column_stack((np.asarray(src[x_name], dtype=float),
+                            np.asarray(src[y_name], dtype=float)))
+
+def annuliCounts(srcCents, nbAnnuli, annSizePix, brightCenters, brightRadii,
+                 tree=None, chunkSize=1000):
+    """ Count detections in `nbAnnuli` annuli of width `annSizePix` starting at the
+    mask radius of every bright object, for all bright objects at once.
+
+    A single KD-tree is built over the (N, 2) source centroids `srcCents` (or
+    `tree` is used if one was already built over them), and each chunk of
+    `chunkSize` bright objects is handled with one batched ball query. Returns
+    the same `(allCounts, allAreas)` arrays, of shape (len(brightCenters),
+    nbAnnuli), as the per-object loop in `countsBeyondMask`."""
+    brightCenters = np.asarray(brightCenters, dtype=float).reshape(-1, 2)
+    brightRadii = np.asarray(brightRadii, dtype=float)
+    nbBright = len(brightCenters)
+    # annuli edges for every bright object, computed as in countsBeyondMask
+    radiiPix = brightRadii[:, None] + np.arange(nbAnnuli + 1) * annSizePix
+    allAreas = np.pi * (radiiPix[:, 1:]**2 - radiiPix[:, :-1]**2)
+    allCounts = np.zeros((nbBright, nbAnnuli), dtype=int)
+    if tree is None:
+        srcCents = np.asarray(srcCents, dtype=float)
+        # sources without a centroid can never fall inside an annulus
+        tree = cKDTree(srcCents[np.all(np.isfinite(srcCents), axis=1)])
+    for start in range(0, nbBright, chunkSize):
+        stop = min(start + chunkSize, nbBright)
+        neighbours = tree.query_ball_point(brightCenters[start:stop], radiiPix[start:stop, -1],
+                                           return_sorted=False)
+        nbNeighbours = np.array([len(nb) for nb in neighbours], dtype=int)
+        if not nbNeighbours.sum():
+            continue
+        srcIdx = np.concatenate(neighbours).astype(int)
+        brightIdx = np.repeat(np.arange(start, stop), nbNeighbours)
+        dist = np.sqrt(np.sum((tree.data[srcIdx] - brightCenters[brightIdx])**2, axis=1))
+        # annulus index of each pair, then nudged so it agrees exactly with the
+        # (dist >= radIn) & (dist < radOut) test used by countInAnnulus
+        annIdx = np.floor((dist - brightRadii[brightIdx]) / annSizePix).astype(int)
+        annIdx = np.clip(annIdx, -1, nbAnnuli)
+        inner = radiiPix[brightIdx, np.clip(annIdx, 0, nbAnnuli)]
+        annIdx[(annIdx >= 0) & (dist < inner)] -= 1
+        outer = radiiPix[brightIdx, np.clip(annIdx + 1, 0, nbAnnuli)]
+        annIdx[(annIdx < nbAnnuli) & (dist >= outer)] += 1
+        keep = (annIdx >= 0) & (annIdx < nbAnnuli)
+        allCounts[start:stop] = np.bincount(
+            (brightIdx[keep] - start) * nbAnnuli + annIdx[keep],
+            minlength=(stop - start) * nbAnnuli).reshape(stop - start, nbAnnuli)
+    return allCounts, allAreas
+
+def sourcesInMasks(srcCents, maskCenters, maskRadii, tree=None, chunkSize=1000):
+    """ Flag the sources at (N, 2) centroids `srcCents` that fall strictly within
+    any of the circular masks of centers `maskCenters` and radii `maskRadii`
+    (in pixels). A single KD-tree is built over the source centroids (or `tree`
+    is used if one was already built over them), and masks are queried in
+    chunks of `chunkSize`.
+    Returns `(masked, maskId)`: a boolean array that is True for masked sources,
+    and the index of the covering mask for each source (-1 if unmasked). When
+    masks overlap, the one whose center is closest relative to its radius wins."""
+    srcCents = np.asarray(srcCents, dtype=float).reshape(-1, 2)
+    maskCenters = np.asarray(maskCenters, dtype=float).reshape(-1, 2)
+    maskRadii = np.asarray(maskRadii, dtype=float)
+    maskId = -np.ones(len(srcCents), dtype=int)
+    # distance to the covering mask's center, in units of its radius
+    bestDist = np.ones(len(srcCents))
+    finite = np.flatnonzero(np.all(np.isfinite(srcCents), axis=1))
+    if tree is None:
+        tree = cKDTree(srcCents[finite])
+    else:
+        finite = np.arange(tree.n)
+    for start in range(0, len(maskCenters), chunkSize):
+        stop = min(start + chunkSize, len(maskCenters))
+        neighbours = tree.query_ball_point(maskCenters[start:stop], maskRadii[start:stop],
+                                           return_sorted=False)
+        nbNeighbours = np.array([len(nb) for nb in neighbours], dtype=int)
+        if not nbNeighbours.sum():
+            continue
+        treeIdx = np.concatenate(neighbours).astype(int)
+        maskIdx = np.repeat(np.arange(start, stop), nbNeighbours)
+        dist = np.sqrt(np.sum((tree.data[treeIdx] - maskCenters[maskIdx])**2, axis=1))
+        relDist = dist / maskRadii[maskIdx]
+        # ball queries include the boundary, the notebooks' dist < radius does not
+        keep = relDist < 1
+        treeIdx, maskIdx, relDist = treeIdx[keep], maskIdx[keep], relDist[keep]
+        # keep the best mask per source, within this chunk then across chunks
+        order = np.lexsort((relDist, treeIdx))
+        treeIdx, maskIdx, relDist = treeIdx[order], maskIdx[order], relDist[order]
+        first = np.ones(len(treeIdx), dtype=bool)
+        first[1:] = treeIdx[1:] != treeIdx[:-1]
+        srcIdx = finite[treeIdx[first]]
+        better = relDist[first] < bestDist[srcIdx]
+        srcIdx = srcIdx[better]
+        bestDist[srcIdx] = relDist[first][better]
+        maskId[srcIdx] = maskIdx[first][better]
+    return maskId >= 0, maskId
+
+def countsBeyondMask(src, nbAnnuli, annSizePix, brightCenters, brightRadii, verbose=False,
+                     useTree=True, x_name="base_SdssCentroid_x", y_name="base_SdssCentroid_y"):
+    """Compute detected source counts around bright star masks.
+    By default, all bright objects are handled at once by `annuliCounts`; set
+    `useTree=False` to loop over them with `countInAnnulus` instead."""
+    if useTree:
+        start = time.time()
+        allCounts, allAreas = annuliCounts(centroidArray(src, x_name, y_name), nbAnnuli,
+                                           annSizePix, brightCenters, brightRadii)
+        if verbose:
+            print(' > {} bright objects; time elapsed: {}s'.format(len(brightRadii),
+                                                                  time.time()-start))
+        return allCounts, allAreas
     allCounts, allAreas = [], []
     for j,brightCen in enumerate(brightCenters):
         start = time.time()
@@ -84,7 +224,7 @@ def countsBeyondMask(src, nbAnnuli, annSizePix, brightCenters, brightRadii, verb
         brad = brightRadii[j]
         #radiiPix = np.arange(brad, brad + annSizePix*(nbAnnuli + 1), annSizePix
         radiiPix = np.array([brad + k*annSizePix for k in range(nbAnnuli+1)])
-        counts, areas = countInAnnulus(src, brightCen, radiiPix)
+        counts, areas = countInAnnulus(src, brightCen, radiiPix, x_name=x_name, y_name=y_name)
         end = time.time()
         if not j%500 and verbose:
             print(' > Bright object {} out of {}; time elapsed for this object: {}s'.format(
@@ -95,19 +235,64 @@ def countsBeyondMask(src, nbAnnuli, annSizePix, brightCenters, brightRadii, verb
     allAreas = np.array(allAreas)
     return allCounts, allAreas
 
+def benchmarkCountsBeyondMask(src, nbAnnuli, annSizePix, brightCenters, brightRadii,
+                              nbLoop=None):
+    """ Time `countsBeyondMask` with and without the KD-tree engine, and check
+    both give the same counts and areas. The loop is slow, so it is only run on
+    the first `nbLoop` bright objects if given, and its timing extrapolated to
+    all of them."""
+    nbBright = len(brightRadii)
+    nbLoop = nbBright if nbLoop is None else min(nbLoop, nbBright)
+    start = time.time()
+    treeCounts, treeAreas = countsBeyondMask(src, nbAnnuli, annSizePix, brightCenters,
+                                             brightRadii)
+    treeTime = time.time() - start
+    start = time.time()
+    loopCounts, loopAreas = countsBeyondMask(src, nbAnnuli, annSizePix, brightCenters[:nbLoop],
+                                             brightRadii[:nbLoop], useTree=False)
+    loopTime = (time.time() - start) * nbBright / max(nbLoop, 1)
+    same = (np.array_equal(treeCounts[:nbLoop], loopCounts.reshape(nbLoop, nbAnnuli)) and
+            np.allclose(treeAreas[:nbLoop], loopAreas.reshape(nbLoop, nbAnnuli)))
+    print('{} bright objects, {} sources: loop {:.2f}s, tree {:.2f}s (x{:.1f}); identical: {}'.format(
+        nbBright, len(src), loopTime, treeTime, loopTime / max(treeTime, 1e-9), same))
+    return loopTime, treeTime, same
+
+def boxesSelector(centers, radii, x0, y0, xWidth, yWidth, extraBuffer=0,
+                  from_center=False):
+    """ Evaluate `boxSelector` for many boxes at once. `centers` is an (N, 2)
+    array, and `x0`, `y0`, `xWidth` and `yWidth` can be scalars or arrays of
+    length M (e.g. from `patchBoxes`); returns an (M, N) boolean array that is
+    True where center n lies inside box m."""
+    centers = np.asarray(centers, dtype=float).reshape(-1, 2)
+    radii = np.asarray(radii, dtype=float)
+    if from_center:
+        buffers = np.zeros(radii.shape) + extraBuffer
+    else:
+        buffers = radii + extraBuffer
+    x0, y0, xWidth, yWidth = (np.atleast_1d(np.asarray(v, dtype=float))[:, None]
+                              for v in (x0, y0, xWidth, yWidth))
+    return ((centers[:, 0] - buffers > x0) &
+            (centers[:, 0] + buffers < x0 + xWidth) &
+            (centers[:, 1] - buffers > y0) &
+            (centers[:, 1] + buffers < y0 + yWidth))
+
 def boxSelector(centers, radii, x0, y0, xWidth, yWidth, extraBuffer=0,
                 from_center=False):
     """ Box selector, to be used as a `furtherBrightObjectSelector` if we are
     not looking at whole tracts at a time.
     If `from_center`, check that centers fall within box; if `False`, that
     circles of radii `radii` do."""
-    if from_center:
-        buffers = np.zeros(radii.shape) + extraBuffer
-    else:
-        buffers = radii + extraBuffer
-    inside = np.array([(cent[0] - buff > x0) &
-                       (cent[0] + buff < x0 + xWidth) &
-                       (cent[1] - buff > y0) &
-                       (cent[1] + buff < y0 + yWidth)
-                   for cent,buff in zip(centers, buffers)])
-    return np.where(inside)[0]
+    inside = boxesSelector(centers, radii, x0, y0, xWidth, yWidth,
+                           extraBuffer=extraBuffer, from_center=from_center)
+    return np.where(inside[0])[0]
+
+def patchBoxes(tractInfo, patches):
+    """ Return the `(x0, y0, xWidth, yWidth)` arrays of the inner bounding boxes
+    of `patches` (given as "x,y" strings, as in `patchList`), to be passed to
+    `boxesSelector`."""
+    boxes = []
+    for patch in patches:
+        index = tuple(int(i) for i in patch.split(','))
+        bBox = tractInfo.getPatchInfo(index).getInnerBBox()
+        boxes += [(bBox.beginX, bBox.beginY, bBox.getWidth(), bBox.getHeight())]
+    return tuple(np.array(boxes, dtype=float).reshape(-1, 4).T)
@@ -0,0 +1,78 @@
+"""Resolution of multiple truth matches for dc2_completeness.
+
+Kept apart from the notebook export so that it can be imported (and tested) without a Butler or
+IPython session.
+"""
+from timeit import default_timer as timer
+
+import numpy as np
+
+
+def _rank_mags(mags):
+    # Brightest first; nan magnitudes are outranked by everything, as in TruthMatcher
+    mags = np.asarray(mags, dtype=float)
+    return np.where(np.isnan(mags), np.inf, mags)
+
+
+def resolve_multiple_matches_loop(indices, mags_true_ref):
+    """Reference implementation of resolve_multiple_matches, one multiple match at a time."""
+    indices = np.copy(indices)
+    mags_rank = _rank_mags(mags_true_ref)
+    # bincount only works on non-negative integers, but we want to preserve the true indices and
+    # don't need the total count of unmatched sources
+    n_matches = np.bincount(indices+1)[1:]
+    matches_multi = n_matches > 1
+    for idx in np.where(matches_multi)[0]:
+        matches = np.where(indices == idx)[0]
+        brightest = np.argmin(mags_rank[matches])
+        indices[matches] = -idx - 2
+        indices[matches[brightest]] = idx
+    return indices
+
+
+def resolve_multiple_matches(indices, mags_true_ref):
+    """Keep only one truth match per measured source.
+
+    indices are the indices of the measured source matched to each truth (-1 if none). Where several
+    truths match the same source idx, the brightest (lowest mags_true_ref, with nan magnitudes last and
+    ties going to the lowest truth index) keeps idx and the others are set to -idx - 2. This is the same
+    brightness order TruthMatcher resolves conflicts in. The result is that of
+    resolve_multiple_matches_loop, but from a single sort over all matches instead of a search per
+    multiple match.
+    """
+    indices = np.copy(indices)
+    matched = np.flatnonzero(indices >= 0)
+    idx_matched = indices[matched]
+    order = np.lexsort((matched, _rank_mags(mags_true_ref)[matched], idx_matched))
+    idx_sorted = idx_matched[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = idx_sorted[1:] != idx_sorted[:-1]
+    group = np.cumsum(first) - 1
+    is_multi = np.bincount(group)[group] > 1
+    losers = matched[order[is_multi & ~first]]
+    indices[losers] = -indices[losers] - 2
+    return indices
+
+
+def benchmark_resolve_multiple_matches(n_truth=500000, n_meas=250000, seed=1, n_repeat=1):
+    """Check that resolve_multiple_matches reproduces the loop version on a synthetic tract-sized
+    catalog and print how long each takes. The loop version scales as N_multi*N_truth."""
+    rng = np.random.default_rng(seed)
+    indices = rng.integers(-1, n_meas, n_truth)
+    mags = rng.uniform(15, 28, n_truth)
+    # include some ties and non-finite magnitudes
+    mags[rng.integers(0, n_truth, n_truth//100)] = 20.
+    mags[rng.integers(0, n_truth, n_truth//1000)] = np.nan
+    start = timer()
+    for _ in range(n_repeat):
+        resolved = resolve_multiple_matches(indices, mags)
+    time_new = (timer() - start)/n_repeat
+    start = timer()
+    resolved_loop = resolve_multiple_matches_loop(indices, mags)
+    time_loop = timer() - start
+    if not np.array_equal(resolved, resolved_loop):
+        raise RuntimeError('resolve_multiple_matches does not match resolve_multiple_matches_loop')
+    n_multi = np.sum(np.bincount(indices + 1)[1:] > 1)
+    print(f'N_truth={n_truth} N_meas={n_meas} N_multi={n_multi}: loop {time_loop:.2f}s,'
+          f' sorted {time_new:.3f}s')
+    return time_loop, time_new
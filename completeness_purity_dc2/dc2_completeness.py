@@ -11,14 +11,21 @@
 # Import requirements
 # This was run with commit bc7c2fa9336390714c6eb00200139bef802aad3c from branch DM-23169 of github.com/lsst-dm/modelling_research.
 # You need that package on your python path for the plotting/dc2 imports to work
+from collections import OrderedDict
+from compure_matching import resolve_multiple_matches
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+import hashlib
 from lsst.daf.persistence import Butler
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import modelling_research.dc2 as dc2
 from modelling_research.plotting import plotjoint_running_percentiles
 import numpy as np
+from scipy.spatial import cKDTree
 import seaborn as sns
 from timeit import default_timer as timer
+import weakref
 
 
 # In[2]:
@@ -124,56 +131,220 @@ def _get_compure_percentiles_mags(edge_mags, x_mags, compures, percentiles, mags
     return mags_pc, pcs_mag
 
 
-def plot_compure(
-    mags, matched, mag_max=None, mag_bin_complete=0.1, 
-    label_x='mag', label_y='Completeness', prefix_title='', postfix_title='',
-    title_middle_n=True, percentiles=None, mags_print=None
-):
+@dataclass
+class CompureResult:
+    """Binned completeness or purity, as computed by compute_compure.
+
+    Bins go from bright to faint: bin i spans (edge_mags[i] - mag_bin, edge_mags[i]].
+    Log counts are -1 for empty bins, as plotted in the marginal axes.
+    """
+    edge_mags: np.ndarray
+    x_mags: np.ndarray
+    mag_bin: float
+    n_within: np.ndarray
+    n_match_true: np.ndarray
+    n_match_false: np.ndarray
+    compure_true: np.ndarray
+    compure_false: np.ndarray
+    errors: np.ndarray
+    percentiles: np.ndarray
+    mags_print: np.ndarray
+    mags_pc: np.ndarray
+    pcs_mag: np.ndarray
+
+    @property
+    def compure(self):
+        return self.compure_true + self.compure_false
+
+    @property
+    def n_total(self):
+        return int(np.sum(self.n_within))
+
+    @property
+    def has_false(self):
+        return any(self.compure_false > 0)
+
+    @property
+    def xlim(self):
+        return self.edge_mags[0] - len(self.edge_mags)*self.mag_bin, self.edge_mags[0]
+
+    @staticmethod
+    def _log_counts(counts):
+        return np.log10(counts, out=-np.ones(len(counts)), where=counts > 0)
+
+    @property
+    def n_withins_log(self):
+        return self._log_counts(self.n_within)
+
+    @property
+    def n_matches_true_log(self):
+        return self._log_counts(self.n_match_true)
+
+    @property
+    def n_matches_false_log(self):
+        return self._log_counts(self.n_match_false)
+
+
+def _bin_compure_counts(mags, matched, mag_max, mag_bin_complete, n_bins, underflow=False):
+    """Count (unmatched, right type, wrong type) matches in n_bins magnitude bins brighter than mag_max.
+
+    All bins are counted with a single bincount over (bin, match type) pairs. If underflow, the last
+    (brightest) bin also counts everything brighter than the grid, instead of dropping it.
+    """
+    mags = np.asarray(mags)
+    matched = np.asarray(matched)
+    mag_bins = np.floor((mag_max - mags)/mag_bin_complete)
+    if underflow:
+        mag_bins = np.minimum(mag_bins, n_bins - 1)
+    valid = (mag_bins >= 0) & (mag_bins < n_bins)
+    # 0: unmatched, 1: right type match, 2: wrong type match
+    match_type = (matched[valid] >= 1) + 2*(matched[valid] <= -1)
+    return np.bincount(
+        3*mag_bins[valid].astype(int) + match_type, minlength=3*n_bins
+    ).reshape(n_bins, 3)
+
+
+def _compure_result_from_counts(counts, mag_max, mag_bin_complete, percentiles=None, mags_print=None):
+    """Make a CompureResult from the binned counts returned by _bin_compure_counts."""
     if percentiles is None:
         percentiles = np.array([0.2, 0.5, 0.6, 0.7, 0.8, 0.9, 0.95])
     if mags_print is None:
         mags_print = 1.
-    if mag_max is None or (not np.isfinite(mag_max)):
-        mag_max = np.ceil(np.max(mags)/mag_bin_complete)*mag_bin_complete
-    n_bins = np.int(np.ceil((mag_max - np.min(mags))/mag_bin_complete)) + 1
-    
-    compure_true, compure_false = (np.zeros(n_bins) for _ in range(2))
-    n_matches_true, n_matches_false, n_withins = (-np.ones(n_bins) for _ in range(3))
-    errors = np.ones(n_bins)
-    mag_bins = np.floor((mag_max - mags)/mag_bin_complete).astype(int)
+    n_bins = counts.shape[0]
+    n_within = np.sum(counts, axis=1)
+    n_match_true, n_match_false = counts[:, 1], counts[:, 2]
+    has_any = n_within > 0
+    compure_true, compure_false = (
+        np.divide(n_match, n_within, out=np.zeros(n_bins), where=has_any)
+        for n_match in (n_match_true, n_match_false)
+    )
+    errors = np.divide(1, np.sqrt(n_within), out=np.ones(n_bins), where=has_any)
     edge_mags = mag_max - np.arange(n_bins)*mag_bin_complete
     x_mags = edge_mags - 0.5*mag_bin_complete
-        
+
     if np.isscalar(mags_print):
         mags_print = np.arange(edge_mags[0], edge_mags[-1], -np.abs(mags_print))[1:]
-    
-    n_total = 0
-    for idx in range(n_bins):
-        within = mag_bins == idx
-        n_match_true = np.sum(matched[within] >= 1)
-        n_match_false = np.sum(matched[within] <= -1)
-        n_within = np.sum(within)
-        n_total += n_within
-        if n_within > 0:
-            compure_true[idx] = n_match_true/n_within
-            compure_false[idx] = n_match_false/n_within
-            errors[idx] = 1/np.sqrt(n_within)
-            n_withins[idx] = np.log10(n_within)
-            if n_match_true > 0:
-                n_matches_true[idx] = np.log10(n_match_true)
-            if n_match_false > 0:
-                n_matches_false[idx] = np.log10(n_match_false)
-
-    xlim = (mag_max - n_bins*mag_bin_complete, mag_max)
-    has_false = any(compure_false > 0)
-    compure = compure_true + compure_false
-    fig = sns.JointGrid(x=x_mags, y=compure, xlim=xlim, ylim=(0, 1))
+    mags_pc, pcs_mag = _get_compure_percentiles_mags(
+        edge_mags, x_mags, compure_true + compure_false, percentiles, mags_print)
+    return CompureResult(
+        edge_mags=edge_mags, x_mags=x_mags, mag_bin=mag_bin_complete, n_within=n_within,
+        n_match_true=n_match_true, n_match_false=n_match_false, compure_true=compure_true,
+        compure_false=compure_false, errors=errors, percentiles=percentiles, mags_print=mags_print,
+        mags_pc=mags_pc, pcs_mag=pcs_mag,
+    )
+
+
+def compute_compure(mags, matched, mag_max=None, mag_bin_complete=0.1, percentiles=None, mags_print=None):
+    """Compute completeness (or purity) in magnitude bins, without plotting.
+
+    matched is >= 1 for right type matches, <= -1 for wrong type matches and 0 otherwise.
+    """
+    if mag_max is None or (not np.isfinite(mag_max)):
+        mag_max = np.ceil(np.max(mags)/mag_bin_complete)*mag_bin_complete
+    n_bins = int(np.ceil((mag_max - np.min(mags))/mag_bin_complete)) + 1
+    counts = _bin_compure_counts(mags, matched, mag_max, mag_bin_complete, n_bins)
+    return _compure_result_from_counts(counts, mag_max, mag_bin_complete, percentiles=percentiles,
+                                       mags_print=mags_print)
+
+
+@dataclass
+class CompureBootstrap:
+    """Bootstrap confidence bands for a CompureResult, as computed by bootstrap_compure.
+
+    Bands are arrays of shape (2, n) of the lower and upper quantiles in interval; mags_pc_band holds the
+    bands of the magnitudes at which completeness (or purity) drops to percentiles_lim. Replicates where a
+    percentile is never reached are ignored for that percentile.
+    """
+    result: CompureResult
+    n_boot: int
+    interval: tuple
+    compure_band: np.ndarray
+    compure_true_band: np.ndarray
+    percentiles_lim: np.ndarray
+    mags_pc_band: np.ndarray
+
+
+def _bootstrap_compure_batch(counts, n_boot, seed, edge_mags, x_mags, percentiles_lim, mags_print):
+    """Draw n_boot bootstrap replicates of binned (unmatched, right, wrong type) counts at once.
+
+    Resampling all N match values with replacement is equivalent to one multinomial draw of the per-bin,
+    per-type counts, so each replicate costs O(n_bins) rather than O(N).
+    """
+    rng = np.random.default_rng(seed)
+    n_bins = counts.shape[0]
+    n_total = np.sum(counts)
+    draws = rng.multinomial(n_total, counts.ravel()/n_total, size=n_boot).reshape(n_boot, n_bins, 3)
+    n_within = np.sum(draws, axis=2)
+    compure_true, compure = (
+        np.divide(n_match, n_within, out=np.zeros((n_boot, n_bins)), where=n_within > 0)
+        for n_match in (draws[:, :, 1], draws[:, :, 1] + draws[:, :, 2])
+    )
+    mags_pc = np.array([
+        _get_compure_percentiles_mags(edge_mags, x_mags, compure_b, percentiles_lim, mags_print)[0]
+        for compure_b in compure
+    ])
+    return compure, compure_true, mags_pc
+
+
+def bootstrap_compure(
+    mags, matched, n_boot=1000, interval=(0.05, 0.95), percentiles_lim=None, batch_size=100,
+    processes=None, seed=None, **kwargs
+):
+    """Compute completeness (or purity) with bootstrap confidence bands.
+
+    The n_boot replicates are drawn batch_size at a time and the batches spread over a process pool with
+    processes workers (or computed serially if processes is 1). Other kwargs are passed to compute_compure.
+    """
+    if percentiles_lim is None:
+        percentiles_lim = np.array([0.5, 0.8, 0.9])
+    result = compute_compure(mags, matched, **kwargs)
+    counts = np.stack(
+        (result.n_within - result.n_match_true - result.n_match_false, result.n_match_true,
+         result.n_match_false),
+        axis=1,
+    )
+    sizes = [min(batch_size, n_boot - start) for start in range(0, n_boot, batch_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    args = [
+        (counts, size, seed_batch, result.edge_mags, result.x_mags, percentiles_lim, result.mags_print)
+        for size, seed_batch in zip(sizes, seeds)
+    ]
+    if processes == 1:
+        batches = [_bootstrap_compure_batch(*arg) for arg in args]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            batches = list(pool.map(_bootstrap_compure_batch, *zip(*args)))
+    compure, compure_true, mags_pc = (np.concatenate(x) for x in zip(*batches))
+    return CompureBootstrap(
+        result=result, n_boot=n_boot, interval=interval,
+        compure_band=np.quantile(compure, interval, axis=0),
+        compure_true_band=np.quantile(compure_true, interval, axis=0),
+        percentiles_lim=percentiles_lim,
+        mags_pc_band=np.nanquantile(mags_pc, interval, axis=0),
+    )
+
+
+def plot_compure_result(
+    result, label_x='mag', label_y='Completeness', prefix_title='', postfix_title='', title_middle_n=True,
+    bootstrap=None,
+):
+    """Plot a CompureResult from compute_compure and return its x-axis limits.
+
+    If bootstrap (a CompureBootstrap of the same result) is given, its confidence band is also shown.
+    """
+    xlim = result.xlim
+    x_mags, edge_mags = result.x_mags, result.edge_mags
+    has_false = result.has_false
+    n_withins = result.n_withins_log
+    fig = sns.JointGrid(x=x_mags, y=result.compure, xlim=xlim, ylim=(0, 1))
     fig.plot_joint(
-        plt.errorbar, yerr=errors, color='k', label='All match' if has_false else None
+        plt.errorbar, yerr=result.errors, color='k', label='All match' if has_false else None
     ).set_axis_labels(label_x, label_y)
+    if bootstrap is not None:
+        fig.ax_joint.fill_between(x_mags, *bootstrap.compure_band, color='k', alpha=0.2, linewidth=0)
     if has_false:
-        sns.lineplot(x_mags, compure_true, color='b', label='Right type')
-        sns.lineplot(x_mags, compure_false, color='r', label='Wrong type')
+        sns.lineplot(x_mags, result.compure_true, color='b', label='Right type')
+        sns.lineplot(x_mags, result.compure_false, color='r', label='Wrong type')
     fig.ax_marg_y.set_axis_off()
     ax = fig.ax_marg_x
     # I couldn't figure out a compelling way to do this in seaborn with distplot, even though it worked in plotjoint. Oh well.   
@@ -183,24 +354,114 @@ def plot_compure(
     ax.set_ylim(-0.25, n_log_max)
     ax.step(edge_mags, n_withins, color='k', where='post')
     if has_false:
-        ax.step(edge_mags, n_matches_true, color='b', where='post')
-        ax.step(edge_mags, n_matches_false, color='r', where='post')
+        ax.step(edge_mags, result.n_matches_true_log, color='b', where='post')
+        ax.step(edge_mags, result.n_matches_false_log, color='r', where='post')
     ticks_y = np.arange(0, n_log_max + 1, label_step)
     ax.yaxis.set_ticks(ticks_y)
     ax.yaxis.set_ticklabels((f'$10^{{{x:.1f}}}$' for x in ticks_y), visible=True)
     ax.tick_params(which='y', direction='out', length=6, width=2, colors='k')
-    title = f' N={n_total}' if title_middle_n else ''
+    title = f' N={result.n_total}' if title_middle_n else ''
     fig.fig.suptitle(f'{prefix_title}{title}{postfix_title}', y=1., verticalalignment='top')
-    mags_pc, pcs_mag = _get_compure_percentiles_mags(edge_mags, x_mags, compure, percentiles, mags_print)
     text_pcs = '\n'.join(f'{100*pc:2.1f}%: {mag_pc:.2f}'
-                         for pc, mag_pc in zip(reversed(percentiles), reversed(mags_pc)))
+                         for pc, mag_pc in zip(reversed(result.percentiles), reversed(result.mags_pc)))
     text_mags = '\n'.join(f'{mag_pc:.2f}: {100*pc:5.1f}%'
-                          for pc, mag_pc in zip(reversed(pcs_mag), reversed(mags_print)))
+                          for pc, mag_pc in zip(reversed(result.pcs_mag), reversed(result.mags_print)))
+    if bootstrap is not None:
+        low, high = (100*x for x in bootstrap.interval)
+        text_pcs = '\n'.join(
+            [text_pcs, '', f'{low:.0f}-{high:.0f}% CI (N_boot={bootstrap.n_boot}):']
+            + [f'{100*pc:2.1f}%: {mag_lo:.2f}-{mag_hi:.2f}'
+               for pc, mag_lo, mag_hi in zip(reversed(bootstrap.percentiles_lim),
+                                             *(reversed(x) for x in bootstrap.mags_pc_band))]
+        )
     fig.fig.text(0.825, 0.95, f'{text_pcs}\n\n{text_mags}', verticalalignment='top')
     plt.show()
     return xlim
 
 
+def plot_compure(
+    mags, matched, mag_max=None, mag_bin_complete=0.1, 
+    label_x='mag', label_y='Completeness', prefix_title='', postfix_title='',
+    title_middle_n=True, percentiles=None, mags_print=None, n_boot=0, **kwargs_boot
+):
+    """Compute and plot completeness (or purity), with bootstrap_compure confidence bands if n_boot > 0."""
+    kwargs_compure = dict(mag_max=mag_max, mag_bin_complete=mag_bin_complete, percentiles=percentiles,
+                          mags_print=mags_print)
+    if n_boot > 0:
+        bootstrap = bootstrap_compure(mags, matched, n_boot=n_boot, **kwargs_boot, **kwargs_compure)
+        result = bootstrap.result
+    else:
+        bootstrap = None
+        result = compute_compure(mags, matched, **kwargs_compure)
+    return plot_compure_result(result, label_x=label_x, label_y=label_y, prefix_title=prefix_title,
+                               postfix_title=postfix_title, title_middle_n=title_middle_n,
+                               bootstrap=bootstrap)
+
+
+class MagnitudeCache:
+    """Bounded LRU cache of model and truth magnitude columns.
+
+    Entries are keyed on the identity of the catalog and model, the band and a digest of the row
+    selection. They only hold weak references to the catalog and model, and are dropped as soon as
+    either is garbage collected (so that their ids can't be reused while cached); objects that can't be
+    weakly referenced are kept alive until the entry is evicted or the cache cleared. Cached magnitudes
+    are read-only; index them to get a modifiable copy.
+    """
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+
+    @staticmethod
+    def _selection_key(selection):
+        if selection is None:
+            return None
+        selection = np.asarray(selection, dtype=bool)
+        return len(selection), hashlib.sha1(np.packbits(selection).tobytes()).hexdigest()
+
+    def _discard(self, key):
+        self._cache.pop(key, None)
+
+    def _get(self, key, refs, compute):
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key][0]
+        mags = compute()
+        if isinstance(mags, np.ndarray):
+            mags.flags.writeable = False
+        strong = []
+        for ref in refs:
+            try:
+                weakref.finalize(ref, self._discard, key)
+            except TypeError:
+                strong.append(ref)
+        self._cache[key] = (mags, strong)
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+        return mags
+
+    def get_total_mag(self, model, cat, band, selection=None):
+        """Return model.get_total_mag(cat[selection], band), computing it only if not cached."""
+        key = (id(model), id(cat), band, self._selection_key(selection))
+        return self._get(key, (model, cat), lambda: model.get_total_mag(
+            cat if selection is None else cat[selection], band))
+
+    def get_truth_mag(self, cat_truth, band, selection=None):
+        """Return the truth magnitudes of cat_truth[selection] in band, computing them only if not cached."""
+        key = ('truth', id(cat_truth), band, self._selection_key(selection))
+        def compute():
+            mags = -2.5 * np.log10(cat_truth[f'lsst_{band}_flux']) + 31.4
+            return np.array(mags if selection is None else mags[selection])
+        return self._get(key, (cat_truth,), compute)
+
+    def clear(self):
+        self._cache.clear()
+
+
+# Shared by _plot_purity and plot_matches, so repeat plots of the same catalogs (e.g. for several radii
+# and object types) reuse magnitudes. Call _mag_cache.clear() to release them before the catalogs go.
+_mag_cache = MagnitudeCache()
+
+
 def _source_is_type(cat, resolved, include_nan=False, threshold=0.5):
     if include_nan:
         return ~_source_is_type(cat, not resolved, threshold=threshold)
@@ -238,7 +499,7 @@ def _plot_purity(
     if has_psf:
         model = models['PSF']
         for band, cat in cats.items():
-            mags_psf[band] = model.get_total_mag(cat[right_types[band]], band)
+            mags_psf[band] = _mag_cache.get_total_mag(model, cat, band, right_types[band])
 
     matched = None
     for name, model in models.items():
@@ -252,7 +513,7 @@ def _plot_purity(
                 matched[indices[matched_any & select_truth]] = 1
                 matched[indices[matched_any & ~select_truth]] = -1
 
-            mags = mags_psf[band] if is_psf else model.get_total_mag(cat[right_type], band)
+            mags = mags_psf[band] if is_psf else _mag_cache.get_total_mag(model, cat, band, right_type)
             within = mags < mag_max
             matched_right = matched[right_type]
             
@@ -279,12 +540,247 @@ def _plot_purity(
                     limx=lim_x, limy=compare_mags_lim_y
                 )
     
+@dataclass
+class TruthMatch:
+    """Truth to measurement matches within a radius, as returned by TruthMatcher.match.
+
+    indices are the index of the measured source matched to each truth (-1 if none), dists the match
+    distances in arcsec (inf if none) and rank which nearest neighbour of the truth was matched
+    (0 for the nearest, -1 if none).
+    """
+    indices: np.ndarray
+    dists: np.ndarray
+    rank: np.ndarray
+
+    @property
+    def matched(self):
+        return self.indices >= 0
+
+    @property
+    def matched_nearest(self):
+        return self.rank == 0
+
+
+def _unit_vectors(ra, dec, degrees=False):
+    ra, dec = (np.radians(x) if degrees else np.asarray(x, dtype=float) for x in (ra, dec))
+    cos_dec = np.cos(dec)
+    return np.column_stack((cos_dec*np.cos(ra), cos_dec*np.sin(ra), np.sin(dec)))
+
+
+class TruthMatcher:
+    """Match truth to measured sources with a single spatial index per tract.
+
+    The n_neighbours nearest measured sources within radius_max_asec of every truth are found once;
+    match then resolves conflicts for any radius up to radius_max_asec in brightness order: the brightest
+    truth gets its nearest measured source, the next brightest its nearest one still unclaimed, etc.
+    Results are cached per radius, so e.g. the 0.168" and 0.5" runs each match only once.
+    """
+    def __init__(self, ra_truth, dec_truth, mags_truth, ra_meas, dec_meas, radius_max_asec=1.,
+                 n_neighbours=8, degrees=False):
+        self.radius_max_asec = radius_max_asec
+        # Faint truths are outranked by bright ones, and nan magnitudes by everything
+        mags = np.asarray(mags_truth, dtype=float)
+        self.priority = np.argsort(np.argsort(np.where(np.isfinite(mags), mags, np.inf), kind='stable'))
+        xyz_meas = _unit_vectors(ra_meas, dec_meas, degrees=degrees)
+        xyz_truth = _unit_vectors(ra_truth, dec_truth, degrees=degrees)
+        good_meas = np.flatnonzero(np.all(np.isfinite(xyz_meas), axis=1))
+        self.n_meas = len(xyz_meas)
+        tree = cKDTree(xyz_meas[good_meas])
+        chord_max = 2*np.sin(np.radians(radius_max_asec/3600.)/2)
+        xyz_truth[~np.all(np.isfinite(xyz_truth), axis=1)] = 0
+        chords, neighbours = tree.query(xyz_truth, k=n_neighbours, distance_upper_bound=chord_max)
+        chords, neighbours = (x.reshape(len(xyz_truth), n_neighbours) for x in (chords, neighbours))
+        found = neighbours < len(good_meas)
+        self.neighbours = np.where(found, good_meas[np.minimum(neighbours, len(good_meas) - 1)], -1)
+        self.dists = np.where(found, 3600*np.degrees(2*np.arcsin(np.minimum(chords, 2)/2)), np.inf)
+        self._matches = {}
+
+    def match(self, radius_asec):
+        if radius_asec > self.radius_max_asec:
+            raise ValueError(f'radius_asec={radius_asec} > radius_max_asec={self.radius_max_asec}')
+        if radius_asec not in self._matches:
+            self._matches[radius_asec] = self._match(radius_asec)
+        return self._matches[radius_asec]
+
+    def _match(self, radius_asec):
+        n_truth, n_neighbours = self.neighbours.shape
+        within = self.dists <= radius_asec
+        rank = -np.ones(n_truth, dtype=int)
+        holder = -np.ones(self.n_meas, dtype=int)
+        free = np.flatnonzero(within[:, 0])
+        # Each round, unmatched truths propose to their next nearest candidate, and each measured source
+        # keeps the brightest truth proposing to or already holding it. Since all measured sources rank
+        # truths the same way, this converges to the brightness-ordered greedy matching.
+        while len(free) > 0:
+            rank[free] += 1
+            candidates = self.neighbours[free, rank[free]]
+            held = np.unique(candidates[holder[candidates] >= 0])
+            truths = np.concatenate((free, holder[held]))
+            candidates = np.concatenate((candidates, held))
+            order = np.lexsort((self.priority[truths], candidates))
+            candidates, truths = candidates[order], truths[order]
+            first = np.ones(len(candidates), dtype=bool)
+            first[1:] = candidates[1:] != candidates[:-1]
+            holder[candidates[first]] = truths[first]
+            rejected = truths[~first]
+            rank_next = rank[rejected] + 1
+            can_retry = rank_next < n_neighbours
+            can_retry[can_retry] = within[rejected[can_retry], rank_next[can_retry]]
+            rank[rejected[~can_retry]] = n_neighbours
+            free = rejected[can_retry]
+        indices = -np.ones(n_truth, dtype=int)
+        held = np.flatnonzero(holder >= 0)
+        indices[holder[held]] = held
+        matched = indices >= 0
+        rank[~matched] = -1
+        dists = np.full(n_truth, np.inf)
+        dists[matched] = self.dists[matched, rank[matched]]
+        return TruthMatch(indices=indices, dists=dists, rank=rank)
+
+
+def make_truth_matchers(cats, band_ref, radius_max_asec=0.5, n_neighbours=8,
+                        columns_coord=('coord_ra', 'coord_dec'), degrees=False):
+    """Make a TruthMatcher for every tract of cats, as returned by dc2.match_refcat.
+
+    Truths are ranked by their band_ref magnitude, and coordinates read from columns_coord of both the
+    truth and band_ref measurement catalogs (in radians, unless degrees).
+    """
+    matchers = {}
+    for tract, cats_type in cats.items():
+        cat_truth, cat_meas = cats_type['truth'], cats_type['meas'][band_ref]
+        mags = -2.5 * np.log10(cat_truth[f'lsst_{band_ref}_flux']) + 31.4
+        matchers[tract] = TruthMatcher(
+            *(cat_truth[c] for c in columns_coord), mags, *(cat_meas[c] for c in columns_coord),
+            radius_max_asec=radius_max_asec, n_neighbours=n_neighbours, degrees=degrees,
+        )
+    return matchers
+
+
+@dataclass
+class CompureCounts:
+    """Binned (unmatched, right type, wrong type) match counts on a fixed magnitude grid.
+
+    Counts on the same grid can be added, so that e.g. per-tract counts can be merged into survey-wide
+    completeness or purity without keeping any catalogs around.
+    """
+    counts: np.ndarray
+    mag_max: float
+    mag_bin: float
+
+    def __add__(self, other):
+        if (self.mag_max, self.mag_bin, self.counts.shape) != (other.mag_max, other.mag_bin, other.counts.shape):
+            raise ValueError('Cannot add CompureCounts on different magnitude grids')
+        return CompureCounts(counts=self.counts + other.counts, mag_max=self.mag_max, mag_bin=self.mag_bin)
+
+    def result(self, percentiles=None, mags_print=None):
+        return _compure_result_from_counts(self.counts, self.mag_max, self.mag_bin, percentiles=percentiles,
+                                           mags_print=mags_print)
+
+
+def compure_counts_tract(
+    cats_type, resolved, models, bands, band_ref, match_dist_asec, mag_max, mag_min=15., mag_bin_complete=0.1,
+    matcher_kwargs=None, field=None,
+):
+    """Count completeness and purity matches for one tract, as plot_matches would plot them.
+
+    cats_type is one tract's entry of the catalogs returned by dc2.match_refcat. Truths are matched with
+    a TruthMatcher if matcher_kwargs (for make_truth_matchers) is not None, otherwise with indices1/dists1
+    as in plot_matches without rematching. Returns a dict of CompureCounts keyed by
+    ('completeness', band) and ('purity', band, model name), binned from mag_max down to mag_min. The
+    grid has to be fixed for counts to be mergeable across tracts, so its brightest bin is an underflow
+    bin that also counts every object brighter than mag_min: none are left out of the totals.
+    """
+    if field is None:
+        field = 'base_ClassificationExtendedness_value'
+    cat_truth, cats_meas = cats_type['truth'], cats_type['meas']
+    select_truth = (cat_truth['id'] > 0) == resolved
+    mags_true = {band: -2.5 * np.log10(cat_truth[f'lsst_{band}_flux']) + 31.4 for band in bands}
+    if matcher_kwargs is not None:
+        matcher = make_truth_matchers({None: cats_type}, band_ref, **matcher_kwargs)[None]
+        indices = matcher.match(match_dist_asec).indices
+    else:
+        indices, dists = (cats_type[x] for x in ('indices1', 'dists1'))
+        indices = np.copy(indices)
+        indices[dists > match_dist_asec] = -1
+        indices = resolve_multiple_matches(indices, mags_true[band_ref])
+    good = indices[select_truth] >= 0
+    n_bins = int(np.ceil((mag_max - mag_min)/mag_bin_complete)) + 1
+
+    def count(mags, matched):
+        return CompureCounts(
+            counts=_bin_compure_counts(mags, matched, mag_max, mag_bin_complete, n_bins, underflow=True),
+            mag_max=mag_max, mag_bin=mag_bin_complete,
+        )
+
+    counts = {}
+    for band in bands:
+        good_mod = np.array(good, dtype=int)
+        extend = np.array(cats_meas[band][field])[indices[select_truth][good]]
+        good_mod[good] -= 2*_source_is_type({field: extend}, not resolved)
+        counts[('completeness', band)] = count(mags_true[band][select_truth], good_mod)
+
+    matched = np.zeros(len(cats_meas[bands[0]]))
+    matched_any = indices >= 0
+    matched[indices[matched_any & select_truth]] = 1
+    matched[indices[matched_any & ~select_truth]] = -1
+    for band in bands:
+        cat = cats_meas[band]
+        right_type = _source_is_type(cat, resolved) & ~cat['merge_footprint_sky']
+        for name, model in models.items():
+            # Not cached: nothing is reused here, and each worker should only hold one tract's catalogs
+            mags = model.get_total_mag(cat[right_type], band)
+            within = mags < mag_max
+            counts[('purity', band, name)] = count(mags[within], matched[right_type][within])
+    return counts
+
+
+def _compure_counts_worker(tract, load_tract, kwargs):
+    return tract, compure_counts_tract(load_tract(tract), **kwargs)
+
+
+def compure_counts_tracts(tracts, load_tract, processes=None, **kwargs):
+    """Count completeness and purity matches over many tracts in a process pool.
+
+    load_tract(tract) must return that tract's entry of the catalogs returned by dc2.match_refcat, and be
+    picklable (i.e. a module-level function or a functools.partial of one), so that each worker only ever
+    holds one tract's catalogs. kwargs are passed to compure_counts_tract. Returns the per-tract counts
+    summed over all tracts, and the dict of per-tract counts.
+    """
+    counts_tracts = {}
+    counts_total = {}
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = [pool.submit(_compure_counts_worker, tract, load_tract, kwargs) for tract in tracts]
+        for future in as_completed(futures):
+            tract, counts = future.result()
+            counts_tracts[tract] = counts
+            for key, counts_key in counts.items():
+                counts_total[key] = counts_total[key] + counts_key if key in counts_total else counts_key
+    return counts_total, counts_tracts
+
+
+def plot_compure_counts(counts, prefix_title='', **kwargs):
+    """Plot every CompureCounts in a dict returned by compure_counts_tracts."""
+    for key, counts_key in counts.items():
+        kind, band = key[:2]
+        name = key[2] if kind == 'purity' else 'true'
+        plot_compure_result(
+            counts_key.result(), label_x=f'${band}_{{{name}}}$',
+            label_y='Purity' if kind == 'purity' else 'Completeness', prefix_title=prefix_title, **kwargs
+        )
+
+
 # Plot model - truth for all models and for mags and colours
 def plot_matches(
     cats, resolved, models, bands=None, band_ref=None, band_ref_multi=None, band_multi=None,
     colors=None, mag_max=None, mag_max_compure=None, match_dist_asec=None, mag_bin_complete=0.1,
-    rematch=False, models_purity=None, plot_diffs=True, compare_mags_psf_lim=None, **kwargs
+    rematch=False, models_purity=None, plot_diffs=True, compare_mags_psf_lim=None, matchers=None, **kwargs
 ):
+    """Plot completeness, purity and model - truth magnitudes for every tract in cats.
+
+    If matchers (a dict of TruthMatcher by tract, see make_truth_matchers) is given, truths are matched
+    with match_dist_asec by brightness-ordered matching instead of the indices1/dists1 nearest-neighbour
+    matches and rematching.
+    """
     if mag_max is None:
         mag_max = np.Inf
     if mag_max_compure is None:
@@ -315,41 +811,37 @@ def plot_matches(
         if band_ref is None:
             band_ref = bands[0]
 
-        mags_true = {band: -2.5 * np.log10(cat_truth[f'lsst_{band}_flux']) + 31.4 for band in bands}
+        mags_true = {band: _mag_cache.get_truth_mag(cat_truth, band) for band in bands}
         good_mags_true = {band: mags_true[band] < mag_max for band in bands}
                 
         if is_afw:
             cats_meas = {band: cat[select_truth] if is_afw else cat for band, cat in cats_meas.items()}
         else:
-            indices, dists = (cats_type[x] for x in ('indices1', 'dists1'))
-            # Cheat a little and set negatives to -1
-            indices = np.copy(indices)
-            indices[dists > match_dist_asec] = -1
-            # bincount only works on non-negative integers, but we want to preserve the true indices and
-            # don't need the total count of unmatched sources
-            n_matches = np.bincount(indices+1)[1:]
-            matches_multi = n_matches > 1
-            mags_true_ref = mags_true[band_ref]
-            
-            # set multiple matches to integers < -1
-            for idx in np.where(matches_multi)[0]:
-                matches = np.where(indices == idx)[0]
-                brightest = np.argmax(mags_true_ref[matches])
-                indices[matches] = -idx - 2
-                indices[matches[brightest]] = idx
+            use_matcher = matchers is not None
+            if use_matcher:
+                # Already resolved in brightness order, so there is nothing to rematch
+                indices = np.copy(matchers[tract].match(match_dist_asec).indices)
+            else:
+                indices, dists = (cats_type[x] for x in ('indices1', 'dists1'))
+                # Cheat a little and set negatives to -1
+                indices = np.copy(indices)
+                indices[dists > match_dist_asec] = -1
+                mags_true_ref = mags_true[band_ref]
+                # set multiple matches to integers < -1
+                indices = resolve_multiple_matches(indices, mags_true_ref)
 
             good = indices[select_truth] >= 0
             
             args_plot = {
                 'mag_max': mag_max_compure, 'mag_bin_complete': mag_bin_complete,
                 'prefix_title': f'DC2 {tract} {obj_type} {match_dist_asec:.2f}asec',
-                'postfix_title': ' !rematch',
+                'postfix_title': ' brightness-ordered' if use_matcher else ' !rematch',
             }
         
             print(f"N={np.sum(cats_meas[band_ref]['merge_footprint_sky'][indices])} sky object matches")
         
             # This took hours and caused much regret
-            if rematch:
+            if rematch and not use_matcher:
                 _plot_completeness(mags_true, cats_meas, good, indices, select_truth, resolved, **args_plot)
                 _plot_purity(
                     models, {band: cats_type['meas'][band] for band in bands}, resolved,
@@ -385,7 +877,7 @@ def plot_matches(
                 cat_truth, indices = (x[select_truth][good] for x in (cat_truth, indices))
                 cats_meas = {band: cat.copy(deep=True).asAstropy()[indices] 
                              for band, cat in cats_meas.items()}
-                mags_true = {band: -2.5 * np.log10(cat_truth[f'lsst_{band}_flux']) + 31.4 for band in bands}
+                mags_true = {band: mags_true[band][select_truth][good] for band in bands}
                 good_mags_true = {band: mags_true[band] < mag_max for band in bands}
 
         for name, model in models.items() if plot_diffs else {}:
@@ -397,7 +889,7 @@ def plot_matches(
                 mags_diff[band] = {}
                 true = mags_true[band]
                 for cat, multi in cats_type:
-                    y = model.get_total_mag(cat if multi else cat[band], band) - true
+                    y = _mag_cache.get_total_mag(model, cat if multi else cat[band], band) - true
                     mags_diff[band][multi] = y
                     x, y = true[good_band], y[good_band]
                     good = np.isfinite(y)
@@ -442,6 +934,9 @@ def plot_matches(
 # close enough true match that wasn't already matched in step 1.
 # 
 # TODO: I think step 3 is first-come first-serve rather than brightness based as in step 2.
+# Passing matchers=make_truth_matchers(cats, band_ref) to plot_matches instead matches all truths in
+# brightness order in one go (brightest first, each to its nearest unclaimed measurement), reusing
+# one spatial index per tract for every match radius.
 # TODO: The matching scheme should probably be replaced with a likelihood based on centroids
 # and magnitudes, given measurement errors on all of the above.
 # 
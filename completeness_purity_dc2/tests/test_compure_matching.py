@@ -0,0 +1,35 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from compure_matching import resolve_multiple_matches, resolve_multiple_matches_loop  # noqa: E402
+
+
+def test_brightest_wins():
+    indices = np.array([0, 0, 0, 1, -1, 2, 2])
+    mags = np.array([22., 18., 25., 20., 15., np.nan, 21.])
+    resolved = resolve_multiple_matches(indices, mags)
+    np.testing.assert_array_equal(resolved, [-2, 0, -2, 1, -1, -4, 2])
+    np.testing.assert_array_equal(resolved, resolve_multiple_matches_loop(indices, mags))
+
+
+def test_ties_go_to_first_truth():
+    indices = np.array([3, 3, 3, 5, 5])
+    mags = np.array([19., 19., 21., np.nan, np.nan])
+    resolved = resolve_multiple_matches(indices, mags)
+    np.testing.assert_array_equal(resolved, [3, -5, -5, 5, -7])
+    np.testing.assert_array_equal(resolved, resolve_multiple_matches_loop(indices, mags))
+
+
+def test_matches_loop_on_random_catalog():
+    rng = np.random.default_rng(3)
+    n_truth, n_meas = 20000, 8000
+    indices = rng.integers(-1, n_meas, n_truth)
+    mags = rng.uniform(15, 28, n_truth)
+    mags[rng.integers(0, n_truth, n_truth//20)] = 20.
+    mags[rng.integers(0, n_truth, n_truth//50)] = np.nan
+    np.testing.assert_array_equal(resolve_multiple_matches(indices, mags),
+                                  resolve_multiple_matches_loop(indices, mags))
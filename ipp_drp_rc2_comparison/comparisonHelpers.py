@@ -1,26 +1,730 @@
-import sys
+import argparse
+import os
+import re
+import sqlite3
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-sys.path.append("/home/czw/.local/lib/python3.6/site-packages/")
-from astrowidgets import ImageWidget
+import astropy.io.fits as FF
+from astropy.table import QTable
+import astropy.units as u
+from scipy.spatial import cKDTree
 
 #
 #
 # Helper to make reading saved data format agnostic.
+#  Files are recognized as Parquet from their magic bytes, anything else is
+#  read as delimited text.  Recently read tables are kept in an LRU cache
+#  keyed on the file (path, mtime, size) and the requested columns/filters.
 
-def pq2df(filename, sep=None):
-    try:
-        with open(filename, 'rb') as f:
-            out = pd.read_parquet(f)
-    except:
-        if sep is None:
-            out = pd.read_csv(filename)
-        else:
-            out = pd.read_csv(filename, sep=sep)
+PQ2DF_CACHE_SIZE = 16
+_pq2dfCache = OrderedDict()
+
+def isParquet(filename):
+    with open(filename, 'rb') as f:
+        return f.read(4) == b'PAR1'
+
+_FILTER_OPS = {'=': lambda c, v: c == v, '==': lambda c, v: c == v,
+               '!=': lambda c, v: c != v,
+               '<': lambda c, v: c < v, '<=': lambda c, v: c <= v,
+               '>': lambda c, v: c > v, '>=': lambda c, v: c >= v,
+               'in': lambda c, v: c.isin(v), 'not in': lambda c, v: ~c.isin(v)}
+
+def applyFilters(df, filters):
+    # Apply Parquet-style filters (a list of (column, op, value) tuples that
+    # are ANDed, or a list of such lists that are ORed) to a DataFrame.
+    if not filters:
+        return df
+    if isinstance(filters[0], tuple):
+        filters = [filters]
+    keep = np.zeros(len(df), dtype=bool)
+    for conjunction in filters:
+        sel = np.ones(len(df), dtype=bool)
+        for col, op, val in conjunction:
+            sel &= np.asarray(_FILTER_OPS[op](df[col], val))
+        keep |= sel
+    return df[keep].reset_index(drop=True)
+
+def pq2df(filename, sep=None, columns=None, filters=None, memory_map=True, cache=True):
+    """Read a Parquet or delimited text table into a DataFrame.
+
+    Only the requested columns are read.  For Parquet files, filters (in
+    the pyarrow form, e.g. [('chip', '==', 8)]) are pushed down to skip row
+    groups; for text files they are applied after reading.  Parquet files
+    are memory mapped unless memory_map is False.  With cache, a copy of
+    a cached table is returned if the file has not changed since it was
+    read with the same columns and filters; the copy is deep, so editing
+    it in place never changes what later calls get.
+    """
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size, sep,
+           None if columns is None else tuple(columns), repr(filters))
+    if cache and key in _pq2dfCache:
+        _pq2dfCache.move_to_end(key)
+        return _pq2dfCache[key].copy()
+
+    if isParquet(filename):
+        out = pd.read_parquet(filename, columns=columns, filters=filters,
+                              memory_map=memory_map)
+    else:
+        usecols = columns
+        if columns is not None and filters:
+            # The filtered columns have to be read too, but not returned.
+            conjunctions = [filters] if isinstance(filters[0], tuple) else filters
+            usecols = list(columns) + [col for conjunction in conjunctions
+                                       for col, op, val in conjunction if col not in columns]
+        out = pd.read_csv(filename, sep=',' if sep is None else sep, usecols=usecols)
+        out = applyFilters(out, filters)
+        if columns is not None:
+            out = out[list(columns)]
+
+    if cache:
+        _pq2dfCache[key] = out
+        if len(_pq2dfCache) > PQ2DF_CACHE_SIZE:
+            _pq2dfCache.popitem(last=False)
+        out = out.copy()
     return out
 
+#
+#
+# Map a common name to the catalog names for both catalog types:
+#  commonName -> (ippName, drpName)
+
+TRANSLATOR = {'id': ('IPP_IDET', 'id'),
+              'x': ('X_PSF', 'base_SdssCentroid_x'), 'y': ('Y_PSF', 'base_SdssCentroid_y'),
+              'ra': ('RA_PSF', 'coord_ra'), 'dec': ('DEC_PSF', 'coord_dec'),
+              'psfFlux': ('PSF_INST_FLUX', 'base_PsfFlux_instFlux'),
+              'psfFluxSig': ('PSF_INST_FLUX_SIG', 'base_PsfFlux_instFluxErr'),
+              'apCorr': ('AP_FLUX', 'base_PsfFlux_apCorr'),
+              'apCorrSig': ('AP_FLUX_SIG', 'base_PsfFlux_apCorrErr'),
+              'sky': ('SKY', 'base_LocalBackground_instFlux'),
+              'skySig': ('SKY_SIGMA', 'base_LocalBackground_instFluxErr'),
+              'nExtSig': ('EXT_NSIGMA', 'base_ClassificationExtendedness_value'),
+              'PSF_MAJOR': ('PSF_MAJOR', 'base_SdssShape_psf_xx'),
+              'PSF_MINOR': ('PSF_MINOR', 'base_SdssShape_psf_yy'),
+              'PSF_THETA': ('PSF_THETA', 'base_SdssShape_psf_xy'),
+              'KRON_FLUX': ('KRON_FLUX', 'ext_photometryKron_KronFlux_instFlux'),
+              'KRON_FLUX_ERR': ('KRON_FLUX_ERR', 'ext_photometryKron_KronFlux_instFluxErr'),
+              'Mxx': ('MOMENTS_XX', 'base_SdssShape_xx'),
+              'Mxy': ('MOMENTS_XY', 'base_SdssShape_xy'),
+              'Myy': ('MOMENTS_YY', 'base_SdssShape_yy'),
+              'flags': ('FLAGS', 'deblend_nChild'),
+             }
+
+#
+#
+# Catalog matching.
+
+def _column(table, name):
+    # Plain values for astropy (Q)Table and pandas columns alike.
+    return np.asarray(table[name])
+
+def match_catalogs(tableA, tableB, radius=3.0, translator=None, return_solo=False):
+    """Match each row of tableA (IPP) to its nearest row of tableB (DRP)
+    within radius, using their common 'X' and 'Y' columns.
+
+    This is the KD-tree equivalent of the notebook's windowed finalMatch:
+    neither table needs to be sorted, and several rows of tableA can
+    match the same row of tableB.  The returned DataFrame has the match
+    distance, the row numbers of both matches, their positions, and the
+    translator (default TRANSLATOR) columns of both tables.  With
+    return_solo, the unmatched rows of each table are also returned, as
+    (matched, soloA, soloB) DataFrames.
+    """
+    if translator is None:
+        translator = TRANSLATOR
+    xyA = np.column_stack((_column(tableA, 'X'), _column(tableA, 'Y')))
+    xyB = np.column_stack((_column(tableB, 'X'), _column(tableB, 'Y')))
+    finiteB = np.flatnonzero(np.all(np.isfinite(xyB), axis=1))
+    finiteA = np.all(np.isfinite(xyA), axis=1)
+    xyA[~finiteA] = 0.0
+
+    dist = np.full(len(xyA), np.inf)
+    nearest = np.zeros(len(xyA), dtype=int)
+    if len(finiteB):
+        dist, nearest = cKDTree(xyB[finiteB]).query(xyA, k=1, distance_upper_bound=radius)
+    good = finiteA & (dist < radius)
+    ippIDs = np.flatnonzero(good)
+    drpIDs = finiteB[nearest[good]]
+    RR = dist[good]
+
+    ippChip = {v[0]: _column(tableA, v[0])[ippIDs] for v in translator.values()}
+    drpChip = {v[1]: _column(tableB, v[1])[drpIDs] for v in translator.values()}
+    DF = pd.DataFrame(data={'matchRadius': RR,
+                            'ippID': ippIDs, 'drpID': drpIDs,
+                            'X_IPP': xyA[ippIDs, 0], 'Y_IPP': xyA[ippIDs, 1],
+                            'X_DRP': xyB[drpIDs, 0], 'Y_DRP': xyB[drpIDs, 1],
+                            **ippChip, **drpChip})
+    if not return_solo:
+        return DF
+
+    soloA = np.ones(len(xyA), dtype=bool)
+    soloA[ippIDs] = False
+    soloB = np.ones(len(xyB), dtype=bool)
+    soloB[drpIDs] = False
+    return DF, _toDataFrame(tableA)[soloA], _toDataFrame(tableB)[soloB]
+
+def _toDataFrame(table):
+    if isinstance(table, pd.DataFrame):
+        return table.reset_index(drop=True)
+    return table.to_pandas()
+
+#
+#
+# Single visit "database": the IPP exposures of the processing database
+#  dump, their SMF files and their pointings from the gen2 registry.
+
+def indexSMFFiles(projDir, dataGroups):
+    """Map 'expName.expId' to the SMF file of that exposure, from one scan
+    of each data group directory (projDir/dataGroup/expName.expId/*.smf)."""
+    smfIndex = {}
+    for dg in dataGroups:
+        try:
+            exposures = [e for e in os.scandir(os.path.join(projDir, dg)) if e.is_dir()]
+        except FileNotFoundError:
+            continue
+        for exp in exposures:
+            with os.scandir(exp.path) as entries:
+                smfs = sorted(e.path for e in entries if e.name.endswith('.smf'))
+            if smfs:
+                smfIndex.setdefault(exp.name, smfs[0])
+    return smfIndex
+
+def _smfIndexDirs(projDir, dataGroups):
+    # The directories indexSMFFiles scans: their mtimes change whenever an
+    # exposure directory or an SMF file is added or removed.
+    dirs = [projDir] if os.path.isdir(projDir) else []
+    for dg in dataGroups:
+        dgDir = os.path.join(projDir, dg)
+        try:
+            with os.scandir(dgDir) as entries:
+                dirs += [e.path for e in entries if e.is_dir()]
+        except FileNotFoundError:
+            continue
+        dirs.append(dgDir)
+    return dirs
+
+def queryPointings(registry, visits, chunk=900):
+    """Map visit to pointing for the given visits, with one IN query per
+    chunk of visits against the registry sqlite3 file."""
+    visits = sorted(set(int(v) for v in visits))
+    pointings = {}
+    conn = sqlite3.connect(registry)
+    try:
+        c = conn.cursor()
+        for start in range(0, len(visits), chunk):
+            batch = visits[start:start + chunk]
+            c.execute('SELECT DISTINCT visit, pointing FROM raw WHERE visit IN '
+                      f'({",".join("?" * len(batch))})', batch)
+            pointings.update(c.fetchall())
+    finally:
+        conn.close()
+    return pointings
+
+def _databaseTypes(db):
+    # The same dtypes whether the database was just built or read back from
+    # its cache file: visit strings and nullable integer pointings.
+    db['visit'] = db['visit'].astype(str)
+    db['pointing'] = db['pointing'].astype('Int64')
+    return db
+
+def makeDatabase(dbselect, projDir, registry, cacheFile=None, force=False):
+    """Build the visit database from the IPP dump dbselect (tab separated,
+    e.g. 00a_dbselect.dat), the SMF files under projDir, and the registry.
+
+    If cacheFile (e.g. db.pqt) is newer than dbselect, the registry and the
+    directories the SMF files are found in, it is read instead, unless force
+    is set; otherwise it is rewritten.
+    """
+    db = pd.read_csv(dbselect, sep='\t', header=0)
+    db = db[db['state'] == 'full'].copy()
+    dataGroups = db['data_group'].unique()
+    if cacheFile is not None and not force and isUpToDate(
+            [cacheFile], [dbselect, registry] + _smfIndexDirs(projDir, dataGroups)):
+        return _databaseTypes(pq2df(cacheFile, cache=False))
+    db['visit'] = [x.split('-')[1] for x in db['exp_name']]
+    smfIndex = indexSMFFiles(projDir, dataGroups)
+    db['IPPSMF'] = [smfIndex.get(f"{expN}.{expI}")
+                    for expN, expI in zip(db['exp_name'], db['exp_id'])]
+    pointings = queryPointings(registry, db['visit'])
+    db['pointing'] = [pointings.get(int(v)) for v in db['visit']]
+    db = _databaseTypes(db)
+    if cacheFile is not None:
+        writeParquet(db, cacheFile)
+    return db
+
+#
+#
+# Per-visit IPP vs DRP matching pipeline.
+#  Each (visit, chip) pair is an independent job; jobs whose outputs are
+#  newer than their inputs are skipped, so an interrupted run can simply
+#  be restarted.
+
+_BUTLERS = {}
+
+def getButler(root):
+    # One butler per repository and process.
+    if root not in _BUTLERS:
+        import lsst.daf.persistence as dafPersist
+        _BUTLERS[root] = dafPersist.Butler(root)
+    return _BUTLERS[root]
+
+def writeParquet(df, filename):
+    # Write to a temporary file next to the target and rename it into
+    # place, so a killed job never leaves a truncated output behind.
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    tmpName = f"{filename}.tmp{os.getpid()}"
+    try:
+        df.to_parquet(tmpName)
+        os.replace(tmpName, filename)
+    finally:
+        if os.path.exists(tmpName):
+            os.remove(tmpName)
+
+def isUpToDate(outputs, inputs):
+    # True if every output exists and is newer than every input.
+    try:
+        oldest = min(os.path.getmtime(f) for f in outputs)
+    except FileNotFoundError:
+        return False
+    return all(os.path.getmtime(f) <= oldest for f in inputs if f is not None)
+
+def chipOutputs(outDir, visitId, chipName):
+    return {kind: os.path.join(outDir, kind, f"v{visitId}-{chipName}.pqt")
+            for kind in ('matched_chip', 'soloIPP', 'soloDRP')}
+
+def prepareIPPTable(data):
+    ippTable = QTable(data)
+    ippTable['PSF_INST_MAG'] = -2.5 * np.log10(ippTable['PSF_INST_FLUX'])
+    ippTable['X'] = 2048.0 - ippTable['X_PSF']
+    ippTable['Y'] = ippTable['Y_PSF']
+    return ippTable
+
+def prepareDRPTable(src):
+    drpTable = QTable(src.asAstropy())
+    drpTable['base_PsfFlux_instMag'] = -2.5 * np.log10(drpTable['base_PsfFlux_instFlux'] / u.ct)
+    drpTable['X'] = drpTable['base_SdssCentroid_x'] / u.pix
+    drpTable['Y'] = drpTable['base_SdssCentroid_y'] / u.pix
+    return drpTable
+
+def listChipJobs(db):
+    """List the (visit, chip, smf, extension) jobs for the rows of db, from
+    the '.psf' extensions of each row's IPP SMF file."""
+    jobs = []
+    for idx, row in db.iterrows():
+        smf = row['IPPSMF']
+        if smf is None or (isinstance(smf, float) and np.isnan(smf)):
+            continue
+        with FF.open(smf, memmap=True) as Fsmf:
+            for ext_number, hdu in enumerate(Fsmf):
+                ext_name = hdu.header.get('EXTNAME', 'PRIMARY')
+                if '.psf' not in ext_name:
+                    continue
+                chipName = ext_name.replace('.psf', "").replace('x', "")
+                jobs.append((row['visit'], chipName, smf, ext_number))
+    return jobs
+
+def matchChip(visitId, chipName, smf, ext_number, outDir, butlerRoot,
+              radius=5.0, force=False):
+    """Match one chip of one visit and write its matched and solo tables.
+
+    Returns the matched_chip file name, or None if there is no DRP 'src'
+    catalog for the chip.  Nothing is done if the outputs are newer than
+    the SMF file and the DRP catalog, unless force is set.
+    """
+    import lsst.daf.persistence as dafPersist
+    butler = getButler(butlerRoot)
+    dataId = {'visit': int(visitId), 'ccd': int(chipName)}
+    try:
+        srcFile = butler.get('src_filename', dataId=dataId)[0]
+    except dafPersist.NoResults:
+        return None
+    if not os.path.exists(srcFile):
+        return None
+    outputs = chipOutputs(outDir, visitId, chipName)
+    if not force and isUpToDate(outputs.values(), (smf, srcFile)):
+        return outputs['matched_chip']
+
+    with FF.open(smf, memmap=True) as Fsmf:
+        ippTable = prepareIPPTable(Fsmf[ext_number].data)
+    drpTable = prepareDRPTable(butler.get('src', dataId=dataId))
+
+    matched, ippSolo, drpSolo = match_catalogs(ippTable, drpTable, radius=radius,
+                                               return_solo=True)
+    matched['chip'] = chipName
+    writeParquet(ippSolo, outputs['soloIPP'])
+    writeParquet(drpSolo, outputs['soloDRP'])
+    # Written last: its presence marks the job as done.
+    writeParquet(matched, outputs['matched_chip'])
+    return outputs['matched_chip']
+
+def combineVisit(outDir, visitId, chipFiles, force=False):
+    # Concatenate the matched chips of a visit into matched/v{visit}.pqt.
+    # Returns None, writing nothing, if the visit has no matched chips.
+    if not chipFiles:
+        return None
+    outFile = os.path.join(outDir, 'matched', f"v{visitId}.pqt")
+    if not force and isUpToDate([outFile], chipFiles):
+        return outFile
+    writeParquet(pd.concat([pq2df(f, cache=False) for f in sorted(chipFiles)], ignore_index=True), outFile)
+    return outFile
+
+def runMatchPipeline(db, outDir, butlerRoot, radius=5.0, processes=None, force=False):
+    """Match all chips of all visits in db over a pool of processes.
+
+    The visit database needs 'visit' and 'IPPSMF' columns (see
+    makeDatabase in the supplement notebook).  Per-chip results go to
+    outDir/{matched_chip,soloIPP,soloDRP}/v{visit}-{chip}.pqt and the
+    per-visit catalogs to outDir/matched/v{visit}.pqt.  Returns the list
+    of per-visit files; visits without any matched chip are skipped.
+    """
+    jobs = listChipJobs(db)
+    chipFiles = {}
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = {pool.submit(matchChip, visitId, chipName, smf, ext_number,
+                               outDir, butlerRoot, radius, force): (visitId, chipName)
+                   for visitId, chipName, smf, ext_number in jobs}
+        for future in as_completed(futures):
+            visitId, chipName = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f"{visitId} {chipName} failed: {e!r}")
+                continue
+            chipFiles.setdefault(visitId, [])
+            if result is not None:
+                chipFiles[visitId].append(result)
+    visitFiles = []
+    for visitId in sorted(set(visitId for visitId, chipName in futures.values())):
+        visitFile = combineVisit(outDir, visitId, chipFiles.get(visitId), force=force)
+        if visitFile is None:
+            print(f"{visitId} skipped: no matched chips")
+            continue
+        visitFiles.append(visitFile)
+    return visitFiles
+
+#
+#
+# Footprint index over coadd patches, visit chips (or IPP skycells): RA/Dec
+#  boxes with their labels, kept as a Parquet table, and queried for many
+#  positions at once.
+
+def _cornerBounds(wcs, corners):
+    # RA/Dec bounds of the sky positions of pixel corners.
+    rd = [wcs.pixelToSky(c[0], c[1]) for c in corners]
+    ra = np.array([x[0].asDegrees() for x in rd])
+    dec = np.array([x[1].asDegrees() for x in rd])
+    # Keep the corners together across RA = 0.
+    ra = ra[0] + (ra - ra[0] + 180.0) % 360.0 - 180.0
+    return {'RAmin': ra.min(), 'RAmax': ra.max(), 'DECmin': dec.min(), 'DECmax': dec.max()}
+
+def patchFootprints(skymap, tracts, filters=None, butler=None):
+    """RA/Dec bounds of every patch of the given tracts, from the skymap
+    geometry only (the tract WCS at the patch outer bbox corners).
+
+    With filters, there is one row per (tract, patch, filter); if a butler
+    is also given, only the coadds it has are listed.
+    """
+    rows = []
+    for T in tracts:
+        tractInfo = skymap[T]
+        wcs = tractInfo.getWcs()
+        nx, ny = tractInfo.getNumPatches()
+        for u in range(nx):
+            for v in range(ny):
+                bb = tractInfo.getPatchInfo((u, v)).getOuterBBox().getCorners()
+                bounds = _cornerBounds(wcs, bb)
+                P = f"{u},{v}"
+                for F in (None, ) if filters is None else filters:
+                    if F is not None and butler is not None and not butler.datasetExists(
+                            'deepCoadd', {'tract': T, 'patch': P, 'filter': F}):
+                        continue
+                    rows.append(dict({'tract': T, 'patch': P, 'filter': F}, **bounds))
+    DF = pd.DataFrame(rows, columns=['tract', 'patch', 'filter',
+                                     'RAmin', 'RAmax', 'DECmin', 'DECmax'])
+    if filters is None:
+        DF = DF.drop(columns='filter')
+    return DF
+
+def visitFootprints(butler, visits, ccds=None):
+    """RA/Dec bounds of every chip of the given visits, from the calexp WCS
+    at its bbox corners (the pixels are not read).
+
+    ccds defaults to the ccds of each visit in the butler registry; chips
+    without a calexp are skipped.  Visits are kept as strings, as in the
+    visit database.
+    """
+    rows = []
+    for V in visits:
+        chips = ccds if ccds is not None else butler.queryMetadata('calexp', 'ccd', visit=int(V))
+        for C in chips:
+            dataId = {'visit': int(V), 'ccd': int(C)}
+            if not butler.datasetExists('calexp', dataId):
+                continue
+            bounds = _cornerBounds(butler.get('calexp_wcs', dataId=dataId),
+                                   butler.get('calexp_bbox', dataId=dataId).getCorners())
+            rows.append(dict({'visit': str(V), 'ccd': int(C)}, **bounds))
+    return pd.DataFrame(rows, columns=['visit', 'ccd', 'RAmin', 'RAmax', 'DECmin', 'DECmax'])
+
+def skycellFootprints(ippDb):
+    # RA/Dec bounds of IPP skycells from the radeg/decdeg/width/height
+    # columns of the stack database dump.
+    DF = ippDb.copy()
+    DF['RAmin'] = DF['radeg'] - DF['width'] / 2.0
+    DF['RAmax'] = DF['radeg'] + DF['width'] / 2.0
+    DF['DECmin'] = DF['decdeg'] - DF['height'] / 2.0
+    DF['DECmax'] = DF['decdeg'] + DF['height'] / 2.0
+    return DF
+
+class FootprintIndex(object):
+    """Index of RA/Dec boxes (the RAmin, RAmax, DECmin, DECmax columns of
+    footprints) for finding the boxes that contain many positions.
+
+    Boxes are sorted by DECmin, so the candidates for a position are one
+    contiguous run of at most the boxes starting within the tallest box
+    height below it; all positions are tested together.  Boxes crossing
+    RA = 0 are split in two.
+    """
+    def __init__(self, footprints):
+        self.footprints = footprints.reset_index(drop=True)
+        raMin = np.asarray(self.footprints['RAmin'], dtype=float)
+        width = np.asarray(self.footprints['RAmax'], dtype=float) - raMin
+        raMin = raMin % 360.0
+        row = np.arange(len(raMin))
+        wraps = raMin + width > 360.0
+        row = np.concatenate((row, row[wraps]))
+        lo = np.concatenate((raMin, np.zeros(np.count_nonzero(wraps))))
+        hi = np.concatenate((np.minimum(raMin + width, 360.0), raMin[wraps] + width[wraps] - 360.0))
+        decMin = np.asarray(self.footprints['DECmin'], dtype=float)[row]
+        decMax = np.asarray(self.footprints['DECmax'], dtype=float)[row]
+
+        order = np.argsort(decMin, kind='stable')
+        self._row = row[order]
+        self._raMin = lo[order]
+        self._raMax = hi[order]
+        self._decMin = decMin[order]
+        self._decMax = decMax[order]
+        self._maxHeight = np.max(decMax - decMin) if len(decMin) else 0.0
+
+    @classmethod
+    def read(cls, filename):
+        return cls(pq2df(filename))
+
+    def write(self, filename):
+        writeParquet(self.footprints, filename)
+
+    def query(self, ra, dec, pad=0.0):
+        """Return (position index, footprint row) pairs for every box, grown
+        by pad degrees, that contains each (ra, dec) position."""
+        ra = np.atleast_1d(np.asarray(ra, dtype=float)) % 360.0
+        dec = np.atleast_1d(np.asarray(dec, dtype=float))
+        lo = np.searchsorted(self._decMin, dec - self._maxHeight - pad, side='left')
+        hi = np.searchsorted(self._decMin, dec + pad, side='right')
+        counts = hi - lo
+        point = np.repeat(np.arange(len(ra)), counts)
+        cand = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + \
+            np.repeat(lo, counts)
+
+        cosDec = np.cos(np.radians(np.clip(np.abs(dec) + pad, 0.0, 90.0)))
+        padRA = np.where(cosDec > pad / 180.0, pad / np.maximum(cosDec, 1e-12), 360.0)[point]
+        dRA = (ra[point] - self._raMin[cand] + padRA) % 360.0
+        good = ((self._decMax[cand] + pad >= dec[point]) &
+                ((dRA <= self._raMax[cand] - self._raMin[cand] + 2 * padRA) | (padRA >= 180.0)))
+        # Both halves of a split box can match; count each box once.
+        nRows = max(len(self.footprints), 1)
+        pairs = np.unique(point[good].astype(np.int64) * nRows + self._row[cand[good]])
+        return pairs // nRows, pairs % nRows
+
+    def lookup(self, ra, dec, pad=0.0, **selection):
+        """Footprints containing each position, as a DataFrame with the
+        position index in 'pointIndex'; keyword arguments select on
+        footprint columns, e.g. filter='HSC-I'."""
+        point, row = self.query(ra, dec, pad=pad)
+        for col, val in selection.items():
+            keep = np.asarray(self.footprints[col])[row] == val
+            point, row = point[keep], row[keep]
+        DF = self.footprints.iloc[row].reset_index(drop=True)
+        DF.insert(0, 'pointIndex', point)
+        return DF
+
+    def cone(self, ra, dec, radius, **selection):
+        """Footprints overlapping a cone of radius degrees (using the box
+        grown by radius, so the result may include near misses)."""
+        return self.lookup(ra, dec, pad=radius, **selection).drop(columns='pointIndex')
+
+#
+#
+# Sample images (e.g. background models) at source positions.
+
+def _imageArray(image):
+    # numpy array and pixel origin of a numpy or afw image.
+    if hasattr(image, 'getArray'):
+        xy0 = image.getXY0()
+        return image.getArray(), (xy0.getX(), xy0.getY())
+    return np.asarray(image), (0, 0)
+
+def sampleImage(image, x, y, method='bilinear', binSize=1, fill=np.nan):
+    """Values of image at the pixel positions (x, y), all in one call.
+
+    image is a 2D array indexed [y, x] or an afw image (whose XY0 is
+    honoured).  For a binned grid such as bg64 or bg128, binSize is the
+    number of full-resolution pixels per grid cell, and x, y stay in
+    full-resolution pixels.  method is 'nearest' or 'bilinear'; positions
+    off the image get fill.
+    """
+    arr, (x0, y0) = _imageArray(image)
+    ny, nx = arr.shape
+    # Grid coordinates, with cell centres at integers.
+    gx = (np.asarray(x, dtype=float) - x0 - (binSize - 1) / 2.0) / binSize
+    gy = (np.asarray(y, dtype=float) - y0 - (binSize - 1) / 2.0) / binSize
+    inside = (gx >= -0.5) & (gx < nx - 0.5) & (gy >= -0.5) & (gy < ny - 0.5)
+    gx = np.where(inside, gx, 0.0)
+    gy = np.where(inside, gy, 0.0)
+    if method == 'nearest':
+        ix = np.clip(np.floor(gx + 0.5).astype(np.int64), 0, nx - 1)
+        iy = np.clip(np.floor(gy + 0.5).astype(np.int64), 0, ny - 1)
+        values = arr[iy, ix].astype(float)
+    elif method == 'bilinear':
+        gx = np.clip(gx, 0, nx - 1)
+        gy = np.clip(gy, 0, ny - 1)
+        ix = np.minimum(np.floor(gx).astype(np.int64), max(nx - 2, 0))
+        iy = np.minimum(np.floor(gy).astype(np.int64), max(ny - 2, 0))
+        fx = gx - ix
+        fy = gy - iy
+        ix1 = np.minimum(ix + 1, nx - 1)
+        iy1 = np.minimum(iy + 1, ny - 1)
+        values = ((1 - fy) * ((1 - fx) * arr[iy, ix] + fx * arr[iy, ix1]) +
+                  fy * ((1 - fx) * arr[iy1, ix] + fx * arr[iy1, ix1]))
+    else:
+        raise ValueError(f"method must be 'nearest' or 'bilinear', not {method!r}")
+    return np.where(inside, values, fill)
+
+def sampleChipImages(images, chips, x, y, **kwargs):
+    """Sample a different image per chip: source i is sampled at (x[i], y[i])
+    in images[chips[i]].  images is a mapping, or a function of the chip
+    returning its image (e.g. loading it from a butler), called once per
+    chip.  Other keyword arguments go to sampleImage.
+    """
+    chips = np.asarray(chips)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    getImage = images if callable(images) else images.__getitem__
+    values = np.full(len(chips), kwargs.get('fill', np.nan))
+    chipList, inverse = np.unique(chips, return_inverse=True)
+    order = np.argsort(inverse, kind='stable')
+    bounds = np.searchsorted(inverse[order], np.arange(len(chipList) + 1))
+    for ii, chip in enumerate(chipList):
+        idx = order[bounds[ii]:bounds[ii + 1]]
+        values[idx] = sampleImage(getImage(chip), x[idx], y[idx], **kwargs)
+    return values
+
+#
+#
+# Per-chip summary statistics of the matched catalogs (sfm_ss.pqt).
+
+STATS_COLUMNS = ['RA_PSF', 'coord_ra', 'DEC_PSF', 'coord_dec',
+                 'PSF_INST_FLUX', 'base_PsfFlux_instFlux',
+                 'KRON_FLUX', 'ext_photometryKron_KronFlux_instFlux']
+STATS_QUANTILES = (0, 25, 50, 75, 100)
+
+def chipStats(df):
+    """Percentiles of the IPP - DRP differences in RA, Dec, PSF and Kron
+    instrumental magnitudes of one matched chip, as a dict with keys
+    dR00, dR25, ..., dK100."""
+    # astrometry:
+    r2d = 180.0 / np.pi
+    diffs = {'dR': df['RA_PSF'] - df['coord_ra'] * r2d,
+             'dD': df['DEC_PSF'] - df['coord_dec'] * r2d,
+             # photometry
+             'dM': np.log10(df['PSF_INST_FLUX']) - np.log10(df['base_PsfFlux_instFlux']),
+             'dK': np.log10(df['KRON_FLUX']) - np.log10(df['ext_photometryKron_KronFlux_instFlux'])}
+    stats = {}
+    for key, diff in diffs.items():
+        with np.errstate(invalid='ignore'):
+            values = np.nanpercentile(np.asarray(diff, dtype=float), STATS_QUANTILES)
+        for Q, value in zip(STATS_QUANTILES, values):
+            stats[f"{key}{Q:02d}"] = value
+    return stats
+
+_CHIP_FILE = re.compile(r'^v(\d+)-(\d+)\.pqt$')
+
+def _chipStatsFile(filename):
+    # Only the columns the statistics need are read.
+    df = pq2df(filename, columns=STATS_COLUMNS, cache=False)
+    if len(df) == 0:
+        return None
+    return chipStats(df)
+
+def reduceChipStats(matchedDir, outFile, filters=None, processes=None, force=False):
+    """Update the per-(visit, chip) statistics table outFile from the
+    v{visit}-{chip}.pqt catalogs in matchedDir.
+
+    Only chips missing from outFile, or whose catalog is newer than it,
+    are read, in parallel over processes; so adding a visit only costs
+    that visit's chips.  filters optionally maps the integer visit number
+    to the filter name (e.g. dict(zip(db['visit'].astype(int), db['filter'])),
+    as db['visit'] holds strings).  Returns the table.
+    """
+    SS = None
+    if os.path.exists(outFile) and not force:
+        SS = pd.read_parquet(outFile)
+        ssTime = os.path.getmtime(outFile)
+        done = set(zip(SS['visit'], SS['chip']))
+
+    todo = []
+    with os.scandir(matchedDir) as entries:
+        for entry in entries:
+            match = _CHIP_FILE.match(entry.name)
+            if match is None:
+                continue
+            key = (int(match.group(1)), int(match.group(2)))
+            if SS is not None and key in done and entry.stat().st_mtime <= ssTime:
+                continue
+            todo.append((key, entry.path))
+    if not todo:
+        return SS
+    todo.sort()
+
+    rows = []
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        results = pool.map(_chipStatsFile, [path for key, path in todo], chunksize=8)
+        for (visit, chip), stats in zip((key for key, path in todo), results):
+            if stats is None:
+                continue
+            rows.append({'visit': visit,
+                         'filter': None if filters is None else filters.get(visit),
+                         'chip': chip, **stats})
+
+    new = pd.DataFrame(rows, columns=['visit', 'filter', 'chip'] +
+                       [f"{key}{Q:02d}" for key in ('dR', 'dD', 'dM', 'dK')
+                        for Q in STATS_QUANTILES])
+    if SS is not None:
+        redone = set(key for key, path in todo)
+        keep = [key not in redone for key in zip(SS['visit'], SS['chip'])]
+        new = pd.concat([SS[keep], new], ignore_index=True)
+    new = new.sort_values(['visit', 'chip'], ignore_index=True)
+    writeParquet(new, outFile)
+    return new
+
+def main():
+    parser = argparse.ArgumentParser(description="Match IPP SMF and DRP src catalogs "
+                                     "for every chip of every visit.")
+    parser.add_argument('db', help="visit database (parquet or csv) with 'visit' and "
+                        "'IPPSMF' columns")
+    parser.add_argument('outDir', help="output directory")
+    parser.add_argument('--butler', required=True, help="DRP repository with the src catalogs")
+    parser.add_argument('--radius', type=float, default=5.0, help="match radius in pixels")
+    parser.add_argument('-j', '--processes', type=int, default=None)
+    parser.add_argument('--force', action='store_true', help="redo up-to-date jobs")
+    args = parser.parse_args()
+    db = pq2df(args.db)
+    db['visit'] = db['visit'].astype(str).str.zfill(7)
+    runMatchPipeline(db, args.outDir, args.butler, radius=args.radius,
+                     processes=args.processes, force=args.force)
+
 #
 #
 # Begin plotting section
@@ -32,11 +736,78 @@ def strCheck(val):
         val = (val, )
     return val
 
+#  Large catalogs are not drawn point by point: above maxPoints, makePlot
+#  either shades the binned point density (rasterized), or draws a
+#  stratified subsample that keeps every point in sparsely populated cells,
+#  so outliers survive while the dense core is thinned.
+
+def _gridCoords(values, lim=None, isLog=False, gridSize=100):
+    # Cell index of each value along one axis, on a linear or log grid.
+    if isLog:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = np.log10(values)
+        if lim is not None:
+            lim = np.log10(lim)
+    if lim is None:
+        finite = values[np.isfinite(values)]
+        lim = (finite.min(), finite.max()) if len(finite) else (0.0, 1.0)
+    lo, hi = lim
+    if not hi > lo:
+        hi = lo + 1.0
+    with np.errstate(invalid='ignore'):
+        cells = np.floor((values - lo) / (hi - lo) * gridSize)
+    return np.clip(np.nan_to_num(cells, nan=0, posinf=gridSize - 1, neginf=0),
+                   0, gridSize - 1).astype(np.int64), (lo, hi)
+
+def thinPoints(XX, YY, maxPoints, xlim=None, ylim=None, logx=False, logy=False,
+               gridSize=100, seed=0):
+    """Indices of about maxPoints of the (XX, YY) points, chosen by capping
+    the expected number of points kept per cell of a gridSize x gridSize
+    grid; cells with fewer points than the cap keep all of theirs."""
+    if len(XX) <= maxPoints:
+        return np.arange(len(XX))
+    ix, _ = _gridCoords(XX, xlim, logx, gridSize)
+    iy, _ = _gridCoords(YY, ylim, logy, gridSize)
+    cell = ix * gridSize + iy
+    counts = np.bincount(cell, minlength=gridSize * gridSize)
+    # Largest per-cell cap that keeps sum(min(counts, cap)) <= maxPoints.
+    lo, hi = 1, counts.max()
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if np.minimum(counts, mid).sum() <= maxPoints:
+            lo = mid
+        else:
+            hi = mid - 1
+    cap = lo
+    # Points of crowded cells are kept with probability cap / count.
+    keepFraction = np.minimum(1.0, cap / np.maximum(counts, 1))
+    return np.flatnonzero(np.random.default_rng(seed).random(len(cell)) < keepFraction[cell])
+
+def densityPlot(ax, XX, YY, xlim=None, ylim=None, logx=False, logy=False, gridSize=200):
+    """Shade the log point density of (XX, YY) as one rasterized mesh."""
+    _, xRange = _gridCoords(XX, xlim, logx, gridSize)
+    _, yRange = _gridCoords(YY, ylim, logy, gridSize)
+    xEdges = np.linspace(*xRange, gridSize + 1)
+    yEdges = np.linspace(*yRange, gridSize + 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        XX = np.log10(XX) if logx else XX
+        YY = np.log10(YY) if logy else YY
+    good = np.isfinite(XX) & np.isfinite(YY)
+    counts, _, _ = np.histogram2d(XX[good], YY[good], bins=(xEdges, yEdges))
+    return ax.pcolormesh(10**xEdges if logx else xEdges, 10**yEdges if logy else yEdges,
+                         np.ma.masked_equal(counts, 0).T, norm=mcolors.LogNorm(),
+                         rasterized=True)
+
 def makePlot(dataframe, xLabels, yLabels,
              loglike=None, diff=False, yf=1.0,
              xlim=None, ylim=None,
-             fig=None, ax=None, colorCol=None
+             fig=None, ax=None, colorCol=None,
+             mode='auto', maxPoints=50000, show=True
             ):
+    # mode is 'scatter' (every point), 'density' or 'sample'; 'auto' picks
+    # 'scatter' up to maxPoints points, and above that 'density' for a
+    # single uncolored pair of columns or 'sample' otherwise.
+    # show=False never calls fig.show(), e.g. when rendering to files.
     doShow = True
     if fig is None:
         fig = plt.figure()
@@ -47,28 +818,50 @@ def makePlot(dataframe, xLabels, yLabels,
     ax.set_alpha(0.9)
     xLabels = strCheck(xLabels)
     yLabels = strCheck(yLabels)
+    logx = loglike is not None and 'x' in loglike
+    logy = loglike is not None and 'y' in loglike
 
+    if colorCol is not None:
+        colorAll = np.asarray(dataframe[colorCol], dtype=float)
     xAxisLabel = []
     yAxisLabel = []
     for xL, yL in zip(xLabels, yLabels):
-        XX = dataframe[xL]
+        XX = np.asarray(dataframe[xL], dtype=float)
         xAxisLabel.append(xL)
 
         if diff:
-            YY = dataframe[xL] - yf * dataframe[yL]
+            YY = XX - yf * np.asarray(dataframe[yL], dtype=float)
             yAxisLabel.append(f"{xL} - {yL}")
         else:
-            YY = yf * dataframe[yL]
+            YY = yf * np.asarray(dataframe[yL], dtype=float)
             yAxisLabel.append(yL)
+        good = ~np.isnan(XX) & ~np.isnan(YY)
+        XX = XX[good]
+        YY = YY[good]
+
+        plotMode = mode
+        if plotMode == 'auto':
+            if len(XX) <= maxPoints:
+                plotMode = 'scatter'
+            elif colorCol is None and len(xLabels) == 1:
+                plotMode = 'density'
+            else:
+                plotMode = 'sample'
+        if plotMode == 'density':
+            densityPlot(ax, XX, YY, xlim, ylim, logx, logy)
+            continue
+        keep = slice(None)
+        if plotMode == 'sample':
+            keep = thinPoints(XX, YY, maxPoints, xlim, ylim, logx, logy)
+
         if colorCol is None:
-            ax.scatter(XX[~np.isnan(XX)], YY[~np.isnan(YY)], marker='.')
+            ax.scatter(XX[keep], YY[keep], marker='.', rasterized=plotMode == 'sample')
         else:
-            colorData = dataframe[colorCol][~np.isnan(XX)].to_numpy(dtype=int) # (dtype=int)/112.0
-            print("ScaleRange:", np.min(colorData), np.max(colorData))
+            colorData = colorAll[good]
             colorData = (colorData - np.min(colorData)) / (np.max(colorData) - np.min(colorData))
 
-            imm = ax.scatter(XX[~np.isnan(XX)], YY[~np.isnan(YY)], marker='.',
-                             c=colorData)
+            imm = ax.scatter(XX[keep], YY[keep], marker='.', c=colorData[keep],
+                             rasterized=plotMode == 'sample')
             fig.colorbar(imm, ax=ax)
 
     if loglike is not None:
@@ -83,16 +876,113 @@ def makePlot(dataframe, xLabels, yLabels,
     ax.set_xlabel(", ".join(xAxisLabel))
     ax.set_ylabel(", ".join(yAxisLabel))
     ax.grid(True)
-    if doShow:
+    if doShow and show:
         fig.show()
 
+#
+#
+# Pre-binned histograms: counts are computed once with numpy, and can be
+#  summed over chips or visits before plotting.
+
+class Histogram(object):
+    """Binned counts of one (1D) or two (2D) columns.
+
+    Histograms with the same bin edges can be added, e.g.
+    sum(hists[1:], hists[0]), to combine chips or visits.
+    """
+    def __init__(self, counts, edges, labels):
+        self.counts = counts
+        self.edges = tuple(edges)
+        self.labels = tuple(labels)
+
+    @property
+    def ndim(self):
+        return len(self.edges)
+
+    def __add__(self, other):
+        if (self.counts.shape != other.counts.shape or
+                not all(np.array_equal(a, b) for a, b in zip(self.edges, other.edges))):
+            raise ValueError("Histograms need identical bin edges to be merged.")
+        return Histogram(self.counts + other.counts, self.edges, self.labels)
+
+    def plot(self, ax, norm=None):
+        if self.ndim == 1:
+            return ax.stairs(self.counts, self.edges[0])
+        return ax.pcolormesh(self.edges[0], self.edges[1],
+                             np.ma.masked_equal(self.counts, 0).T,
+                             norm=mcolors.LogNorm() if norm is None else norm)
+
+def mergeHistograms(hists):
+    hists = list(hists)
+    return sum(hists[1:], hists[0])
+
+def _histValues(dataframe, xL, yL=None, yf=1.0):
+    XX = np.asarray(dataframe[xL], dtype=float)
+    if yL is None:
+        return XX, xL
+    return XX - yf * np.asarray(dataframe[yL], dtype=float), f"{xL} - {yL}"
+
+def _finiteRange(values):
+    values = values[np.isfinite(values)]
+    if len(values) == 0:
+        return (0.0, 1.0)
+    return (values.min(), values.max())
+
+def _commonRange(ranges):
+    ranges = np.asarray(ranges, dtype=float)
+    return (ranges[:, 0].min(), ranges[:, 1].max())
+
+def histogram1D(dataframe, xL, yL=None, yf=1.0, Nbins=100, range=None):
+    """Histogram of dataframe[xL] (or of dataframe[xL] - yf * dataframe[yL])."""
+    return _histogram1D(dataframe, xL, yL, yf, Nbins, range)
+
+def _histogram1D(dataframe, xL, yL, yf, Nbins, range, values=None):
+    # values, if given, is the _histValues result for this frame.
+    XX, label = _histValues(dataframe, xL, yL, yf) if values is None else values
+    XX = XX[~np.isnan(XX)]
+    counts, edges = np.histogram(XX, bins=Nbins,
+                                 range=_finiteRange(XX) if range is None else range)
+    return Histogram(counts, (edges, ), (label, ))
+
+def _hist2DValues(dataframe, xL, yL, zL=None, diff=False, yf=1.0):
+    XX = np.asarray(dataframe[xL], dtype=float)
+    if diff is True:
+        YY, yLabel = _histValues(dataframe, xL if zL is None else zL, yL, yf)
+    else:
+        YY, yLabel = np.asarray(dataframe[yL], dtype=float), yL
+    good = np.isfinite(XX) & np.isfinite(YY)
+    return XX[good], YY[good], xL, yLabel
+
+def histogram2D(dataframe, xL, yL, zL=None, diff=False, yf=1.0, Nbins=100, range=None):
+    """2D histogram of dataframe[xL] against dataframe[yL] (or, with diff,
+    against dataframe[zL or xL] - yf * dataframe[yL])."""
+    return _histogram2D(dataframe, xL, yL, zL, diff, yf, Nbins, range)
+
+def _histogram2D(dataframe, xL, yL, zL, diff, yf, Nbins, range, values=None):
+    # values, if given, is the _hist2DValues result for this frame.
+    XX, YY, xLabel, yLabel = (_hist2DValues(dataframe, xL, yL, zL, diff, yf)
+                              if values is None else values)
+    histRange = range
+    if histRange is None:
+        histRange = (_finiteRange(XX), _finiteRange(YY))
+    counts, xEdges, yEdges = np.histogram2d(XX, YY, bins=Nbins, range=histRange)
+    return Histogram(counts, (xEdges, yEdges), (xLabel, yLabel))
+
+def _frameList(dataframe):
+    if isinstance(dataframe, (list, tuple)):
+        return list(dataframe)
+    return [dataframe]
+
 def makeHistPlot(dataframe, xLabels, yLabels=None,
                  loglike=None, yf=1.0,
                  Nbins=100,
                  xlim=None, ylim=None,
-                 fig=None, ax=None
-
+                 fig=None, ax=None,
+                 aggregate=False, show=True
                 ):
+    # With aggregate, the counts come from histogram1D, and
+    # dataframe may be a list of frames (e.g. chips) whose counts are summed.
+    # show=False never calls fig.show(), e.g. when rendering to files.
     doShow = True
     if fig is None:
         fig = plt.figure()
@@ -106,6 +996,19 @@ def makeHistPlot(dataframe, xLabels, yLabels=None,
     xAxisLabel = []
     yAxisLabel = []
     for xL, yL in zip(xLabels, yLabels):
+        if aggregate:
+            frames = _frameList(dataframe)
+            histRange = xlim
+            values = [None] * len(frames)
+            if histRange is None and len(frames) > 1:
+                # The differences are computed once, for both the range and the counts.
+                values = [_histValues(f, xL, yL, yf) for f in frames]
+                histRange = _commonRange([_finiteRange(v[0]) for v in values])
+            hist = mergeHistograms(_histogram1D(f, xL, yL, yf, Nbins, histRange, v)
+                                   for f, v in zip(frames, values))
+            hist.plot(ax)
+            xAxisLabel.append(hist.labels[0])
+            continue
         if yL is not None:
             XX = dataframe[xL] - yf * dataframe[yL]
             xAxisLabel.append(f"{xL} - {yL}")
@@ -127,7 +1030,7 @@ def makeHistPlot(dataframe, xLabels, yLabels=None,
     ax.set_ylabel("Counts")
     ax.grid(True)
 
-    if doShow:
+    if doShow and show:
         fig.show()
 
 def makeHist2DPlot(dataframe, xLabels, yLabels, zLabels=None,
@@ -135,22 +1038,40 @@ def makeHist2DPlot(dataframe, xLabels, yLabels, zLabels=None,
                    yf=1.0,
                    Nbins=100,
                    range=None,
-                   fig=None, ax=None
-
+                   fig=None, ax=None,
+                   aggregate=False, show=True
                 ):
+    # With aggregate, the counts come from histogram2D, and
+    # dataframe may be a list of frames (e.g. chips) whose counts are summed.
+    # show=False never calls fig.show(), e.g. when rendering to files.
     doShow = True
     if fig is None:
         fig = plt.figure()
         doShow = False
     if ax is None:
         ax = plt.gca()
-        doShow is False
+        doShow = False
     xLabels = strCheck(xLabels)
     yLabels = strCheck(yLabels)
     zLabels = strCheck(zLabels)
     xAxisLabel = []
     yAxisLabel = []
     for xL, yL, zL in zip(xLabels, yLabels, zLabels):
+        if aggregate:
+            frames = _frameList(dataframe)
+            histRange = range
+            values = [None] * len(frames)
+            if histRange is None and len(frames) > 1:
+                # The differences are computed once, for both the range and the counts.
+                values = [_hist2DValues(f, xL, yL, zL, diff, yf) for f in frames]
+                histRange = (_commonRange([_finiteRange(v[0]) for v in values]),
+                             _commonRange([_finiteRange(v[1]) for v in values]))
+            hist = mergeHistograms(_histogram2D(f, xL, yL, zL, diff, yf, Nbins, histRange, v)
+                                   for f, v in zip(frames, values))
+            hist.plot(ax)
+            xAxisLabel.append(hist.labels[0])
+            yAxisLabel.append(hist.labels[1])
+            continue
         XX = dataframe[xL]
         xAxisLabel.append(xL)
         if diff is True:
@@ -171,7 +1092,7 @@ def makeHist2DPlot(dataframe, xLabels, yLabels, zLabels=None,
             ax.set_yscale('log')
     ax.set_xlabel(", ".join(xAxisLabel))
     ax.set_ylabel(", ".join(yAxisLabel))
-    if doShow:
+    if doShow and show:
         fig.show()
 
 #
@@ -184,5 +1105,5 @@ range3 = (-1e-3, 1e-3)
 range4 = (-1e-4, 1e-4)
 range5 = (-1e-5, 1e-5)
 
-
-
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+"""Render the IPP vs DRP comparison plots for many visits to PNG files and
+an index HTML page, without a display.
+
+A report is a list of plot specs, each a dict with:
+  name     used for the output directory and the index section (required)
+  kind     'plot', 'hist' or 'hist2d' (makePlot, makeHistPlot, makeHist2DPlot)
+  x, y, z  column names, passed as the positional column arguments
+  groupby  'visit' (one plot per matched file), 'chip' (one plot per chip
+           of each file) or None (one plot of all files together)
+  title    optional plot title
+Every other key is passed to the plotting function, and the strings
+'range0' ... 'range5' anywhere in those values stand for the range
+shortcuts of comparisonHelpers, so specs can be read from JSON.
+
+    python comparisonReport.py report/ /project/czw/rc2_comp.20200217/matched/v*.pqt -j 16
+"""
+import argparse
+import html
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+import comparisonHelpers as CH
+
+#
+#
+# Magnitudes the notebooks add to the matched catalogs: magName -> fluxName
+
+MAG_COLUMNS = {'PSF_INST_MAG': 'PSF_INST_FLUX',
+               'KRON_MAG': 'KRON_FLUX',
+               'AP_MAG': 'AP_FLUX',
+               'base_PsfFlux_instMag': 'base_PsfFlux_instFlux',
+               'ext_photometryKron_KronFlux_instMag': 'ext_photometryKron_KronFlux_instFlux',
+              }
+
+PLOT_FUNCTIONS = {'plot': CH.makePlot, 'hist': CH.makeHistPlot, 'hist2d': CH.makeHist2DPlot}
+
+SPEC_KEYS = ('name', 'kind', 'x', 'y', 'z', 'groupby', 'title')
+
+r2d = 180.0 / np.pi
+
+DEFAULT_SPECS = [
+    {'name': 'dRA', 'kind': 'hist', 'x': 'RA_PSF', 'y': 'coord_ra', 'yf': r2d, 'xlim': 'range4'},
+    {'name': 'dDEC', 'kind': 'hist', 'x': 'DEC_PSF', 'y': 'coord_dec', 'yf': r2d, 'xlim': 'range4'},
+    {'name': 'dPSFmag', 'kind': 'hist', 'x': 'PSF_INST_MAG', 'y': 'base_PsfFlux_instMag',
+     'xlim': 'range1'},
+    {'name': 'dKRONmag', 'kind': 'hist', 'x': 'KRON_MAG', 'y': 'ext_photometryKron_KronFlux_instMag',
+     'xlim': [-1, 1]},
+    {'name': 'dPSFmag_vs_mag', 'kind': 'hist2d', 'x': 'PSF_INST_MAG', 'y': 'base_PsfFlux_instMag',
+     'z': 'PSF_INST_MAG', 'diff': True, 'range': [[-16, -7], 'range1']},
+    {'name': 'dPSFmag_chip', 'kind': 'hist', 'x': 'PSF_INST_MAG', 'y': 'base_PsfFlux_instMag',
+     'xlim': 'range1', 'groupby': 'chip'},
+    {'name': 'dPSFmag_all', 'kind': 'hist', 'x': 'PSF_INST_MAG', 'y': 'base_PsfFlux_instMag',
+     'xlim': 'range1', 'groupby': None},
+]
+
+def resolveRanges(value):
+    # Replace 'rangeN' strings by the comparisonHelpers shortcuts.
+    if isinstance(value, str) and value.startswith('range') and hasattr(CH, value):
+        return getattr(CH, value)
+    if isinstance(value, (list, tuple)):
+        return tuple(resolveRanges(v) for v in value)
+    return value
+
+def specColumns(spec):
+    # Columns to read for a spec; magnitudes are read as their fluxes.
+    columns = [spec.get(k) for k in ('x', 'y', 'z')] + [spec.get('colorCol')]
+    if spec.get('groupby', 'visit') == 'chip':
+        columns.append('chip')
+    columns = [MAG_COLUMNS.get(c, c) for c in columns if c is not None]
+    return list(dict.fromkeys(columns))
+
+def loadFrame(filename, spec, chip=None):
+    filters = None if chip is None else [('chip', '==', chip)]
+    df = CH.pq2df(filename, columns=specColumns(spec), filters=filters, cache=False)
+    for col in (spec.get('x'), spec.get('y'), spec.get('z')):
+        if col in MAG_COLUMNS and col not in df:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                df[col] = -2.5 * np.log10(df[MAG_COLUMNS[col]])
+    return df
+
+def visitLabel(filename):
+    return os.path.splitext(os.path.basename(filename))[0]
+
+def listJobs(specs, filenames, outDir):
+    """List (spec, files, chip, label, pngFile) render jobs for the specs."""
+    jobs = []
+    chips = {}
+    for spec in specs:
+        groupby = spec.get('groupby', 'visit')
+        specDir = os.path.join(outDir, spec['name'])
+        if groupby is None:
+            jobs.append((spec, list(filenames), None, 'all', os.path.join(specDir, 'all.png')))
+            continue
+        for filename in filenames:
+            label = visitLabel(filename)
+            if groupby == 'visit':
+                jobs.append((spec, [filename], None, label, os.path.join(specDir, f"{label}.png")))
+            elif groupby == 'chip':
+                if filename not in chips:
+                    chips[filename] = sorted(CH.pq2df(filename, columns=['chip'],
+                                                      cache=False)['chip'].unique())
+                for chip in chips[filename]:
+                    chipLabel = f"{label}-{chip}"
+                    jobs.append((spec, [filename], chip, chipLabel,
+                                 os.path.join(specDir, f"{chipLabel}.png")))
+            else:
+                raise ValueError(f"Unknown groupby {groupby!r} in spec {spec['name']}.")
+    return jobs
+
+def renderPlot(spec, filenames, chip, label, pngFile):
+    """Render one spec for the given matched files (and chip) to pngFile."""
+    kind = spec.get('kind', 'hist')
+    kwargs = {k: resolveRanges(v) for k, v in spec.items() if k not in SPEC_KEYS}
+    frames = [loadFrame(f, spec, chip) for f in filenames]
+    if len(frames) == 1:
+        dataframe = frames[0]
+    elif kind == 'plot':
+        dataframe = pd.concat(frames, ignore_index=True)
+    else:
+        # Histograms of several files are summed rather than concatenated.
+        dataframe = frames
+        kwargs['aggregate'] = True
+    columns = [spec[k] for k in ('x', 'y', 'z') if spec.get(k) is not None]
+
+    fig, ax = plt.subplots()
+    try:
+        PLOT_FUNCTIONS[kind](dataframe, *columns, fig=fig, ax=ax, show=False, **kwargs)
+        ax.set_title(spec.get('title', f"{spec['name']} {label}"))
+        os.makedirs(os.path.dirname(pngFile), exist_ok=True)
+        tmpName = f"{pngFile}.tmp{os.getpid()}.png"
+        fig.savefig(tmpName)
+        os.replace(tmpName, pngFile)
+    finally:
+        plt.close(fig)
+    return pngFile
+
+def writeIndex(outDir, specs, rendered):
+    """Write outDir/index.html with one section of images per spec."""
+    lines = ['<!DOCTYPE html>', '<html><head><meta charset="utf-8">',
+             '<title>IPP vs DRP comparison</title></head><body>',
+             '<h1>IPP vs DRP comparison</h1>']
+    for spec in specs:
+        lines.append(f"<h2>{html.escape(spec['name'])}</h2>")
+        for label, pngFile in sorted(rendered.get(spec['name'], [])):
+            src = html.escape(os.path.relpath(pngFile, outDir))
+            lines.append(f'<figure style="display:inline-block"><a href="{src}">'
+                         f'<img src="{src}" width="400"></a>'
+                         f'<figcaption>{html.escape(str(label))}</figcaption></figure>')
+    lines.append('</body></html>')
+    indexFile = os.path.join(outDir, 'index.html')
+    with open(indexFile + '.tmp', 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(indexFile + '.tmp', indexFile)
+    return indexFile
+
+def makeReport(filenames, outDir, specs=None, processes=None):
+    """Render specs (default DEFAULT_SPECS) for the matched catalog files
+    over a pool of processes, and write the index page.  Returns its name."""
+    specs = DEFAULT_SPECS if specs is None else specs
+    os.makedirs(outDir, exist_ok=True)
+    rendered = {}
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        futures = {pool.submit(renderPlot, *job): job
+                   for job in listJobs(specs, filenames, outDir)}
+        for future in as_completed(futures):
+            spec, files, chip, label, pngFile = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                print(f"{spec['name']} {label} failed: {e!r}")
+                continue
+            rendered.setdefault(spec['name'], []).append((label, pngFile))
+    return writeIndex(outDir, specs, rendered)
+
+def main():
+    parser = argparse.ArgumentParser(description="Render IPP vs DRP comparison plots "
+                                     "to PNG files and an index page.")
+    parser.add_argument('outDir', help="output directory")
+    parser.add_argument('filenames', nargs='+', help="matched catalogs (e.g. matched/v*.pqt)")
+    parser.add_argument('--specs', default=None, help="JSON file with a list of plot specs")
+    parser.add_argument('-j', '--processes', type=int, default=None)
+    args = parser.parse_args()
+    specs = None
+    if args.specs is not None:
+        with open(args.specs) as f:
+            specs = json.load(f)
+    print(makeReport(args.filenames, args.outDir, specs=specs, processes=args.processes))
+
+if __name__ == '__main__':
+    main()
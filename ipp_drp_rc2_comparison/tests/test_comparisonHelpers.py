@@ -0,0 +1,121 @@
+import os
+import sqlite3
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import comparisonHelpers as CH  # noqa: E402
+
+N_VISITS = 2000
+
+
+@pytest.fixture
+def registry(tmp_path):
+    filename = str(tmp_path / 'registry.sqlite3')
+    conn = sqlite3.connect(filename)
+    conn.execute('CREATE TABLE raw (visit INTEGER, ccd INTEGER, pointing INTEGER)')
+    # several ccds per visit, as in the gen2 registry
+    conn.executemany('INSERT INTO raw VALUES (?, ?, ?)',
+                     [(visit, ccd, visit // 10) for visit in range(N_VISITS) for ccd in range(3)])
+    conn.commit()
+    conn.close()
+    return filename
+
+
+@pytest.fixture
+def ippData(tmp_path):
+    projDir = tmp_path / 'proj'
+    rows = []
+    for i in range(6):
+        expName, expId, dataGroup = f"o{i}-{i + 10}", 100 + i, f"dg{i % 2}"
+        expDir = projDir / dataGroup / f"{expName}.{expId}"
+        expDir.mkdir(parents=True)
+        if i != 5:
+            (expDir / f"{expName}.smf").touch()
+        rows.append({'exp_name': expName, 'exp_id': expId, 'data_group': dataGroup,
+                     'state': 'full' if i else 'drop'})
+    dbselect = str(tmp_path / '00a_dbselect.dat')
+    pd.DataFrame(rows).to_csv(dbselect, sep='\t', index=False)
+    return dbselect, str(projDir)
+
+
+@pytest.mark.parametrize('chunk', [900, 7])
+def test_queryPointings_chunks(registry, chunk):
+    visits = [str(v) for v in range(N_VISITS)] + ['5', '12345']
+    pointings = CH.queryPointings(registry, visits, chunk=chunk)
+    assert pointings == {visit: visit // 10 for visit in range(N_VISITS)}
+
+
+def test_makeDatabase_cache_round_trip(tmp_path, registry, ippData):
+    dbselect, projDir = ippData
+    cacheFile = str(tmp_path / 'db.pqt')
+    built = CH.makeDatabase(dbselect, projDir, registry, cacheFile=cacheFile)
+    assert list(built['visit']) == ['11', '12', '13', '14', '15']
+    assert built['IPPSMF'].isna().sum() == 1
+    cached = CH.makeDatabase(dbselect, projDir, registry, cacheFile=cacheFile)
+    pd.testing.assert_series_equal(built.dtypes, cached.dtypes)
+    pd.testing.assert_frame_equal(built.reset_index(drop=True), cached.reset_index(drop=True))
+
+
+def test_makeDatabase_sees_new_smf_files(tmp_path, registry, ippData):
+    dbselect, projDir = ippData
+    cacheFile = str(tmp_path / 'db.pqt')
+    CH.makeDatabase(dbselect, projDir, registry, cacheFile=cacheFile)
+    smf = os.path.join(projDir, 'dg1', 'o5-15.105', 'o5-15.smf')
+    open(smf, 'w').close()
+    # make sure the cache is older than the new file, whatever the mtime resolution
+    os.utime(cacheFile, (0, 0))
+    os.utime(dbselect, (0, 0))
+    os.utime(registry, (0, 0))
+    db = CH.makeDatabase(dbselect, projDir, registry, cacheFile=cacheFile)
+    assert db['IPPSMF'].iloc[-1] == smf
+
+
+class _Angle(float):
+    def asDegrees(self):
+        return float(self)
+
+
+class _Wcs(object):
+    # 1 arcmin pixels, from (ra0, dec0) at pixel (0, 0)
+    def __init__(self, ra0, dec0):
+        self.ra0, self.dec0 = ra0, dec0
+
+    def pixelToSky(self, x, y):
+        return (_Angle((self.ra0 + x / 60.0) % 360.0), _Angle(self.dec0 + y / 60.0))
+
+
+class _BBox(object):
+    def getCorners(self):
+        return [(0, 0), (59, 0), (59, 119), (0, 119)]
+
+
+class _Butler(object):
+    # visit 1 has ccds 0 and 1 on either side of RA = 0, ccd 2 has no calexp
+    origins = {(1, 0): (359.5, 0.0), (1, 1): (0.5, 0.0)}
+
+    def queryMetadata(self, datasetType, key, visit):
+        return [0, 1, 2]
+
+    def datasetExists(self, datasetType, dataId):
+        return (dataId['visit'], dataId['ccd']) in self.origins
+
+    def get(self, datasetType, dataId):
+        if datasetType == 'calexp_wcs':
+            return _Wcs(*self.origins[(dataId['visit'], dataId['ccd'])])
+        return _BBox()
+
+
+def test_visitFootprints_index():
+    footprints = CH.visitFootprints(_Butler(), ['1'])
+    assert list(footprints['ccd']) == [0, 1]
+    assert footprints.loc[0, 'RAmax'] - footprints.loc[0, 'RAmin'] < 1.0
+    index = CH.FootprintIndex(footprints)
+    found = index.lookup([0.2, 359.8, 0.8, 10.0], [0.5, 1.9, 0.1, 0.5])
+    assert list(zip(found['pointIndex'], found['visit'], found['ccd'])) == [
+        (0, '1', 0), (1, '1', 0), (2, '1', 1)]
+    assert np.all(found['DECmin'] <= [0.5, 1.9, 0.1])